@@ -1,63 +1,93 @@
 #!/usr/bin/python
 import argparse
+import itertools
 import os
 
 from PIL import Image
 from analyzer import Analyzer, AnalyzerError, load_colors
+import cache
+import instrument
+import parallel
 
-errors = 0
+# groups of pixels with at most this size are considered noise
+GROUP_THRESHOLD = 20
 
-def clear_background_for_image(source, target, colors, verbose = True):
+# file in the target directory with stages and counters of each image
+TIMINGS = "timings.jsonl"
+
+def clear_background_for_image(source, target, colors, verbose = True, hooks = ()):
     """Clear background of source image.
     
     Result is a black and white image in png format. White color 
-    coresponds to foreground pixels, black color to background pixels."""
+    coresponds to foreground pixels, black color to background pixels.
+    Stages and counters are passed to 'hooks', see instrument.Recorder.
+    Returns tuple (errors, record) where errors is number of errors and
+    record holds the stages and counters."""
     print "%s -> %s" % (source, target)
-    img = Image.open(source)
-    gray = img.convert("L")
+    recorder = instrument.Recorder(source, hooks)
+    with recorder.stage("load"):
+        img = Image.open(source)
+        gray = img.convert("L")
     # compute mean color
     total = (gray.size[0] * gray.size[1])
     mean = sum((col * n for col, n in gray.getcolors())) / total
     try:
-        analyzer = Analyzer(img, colors, verbose)
+        analyzer = Analyzer(img, colors, verbose, recorder = recorder)
         pixels, groups, indexes = analyzer.filter_background(gray, 
                 color_threshold = mean - 30) # 
         analyzer.save_pixels(target, pixels)
     except AnalyzerError as e:
         print "Error: %s: %s" % (source, str(e))
-        errors = errors + 1
+        return 1, recorder.record(str(e))
+    return 0, recorder.record()
 
 
-def clear_background_for_image2(source, target, colors, verbose = True):
+def clear_background_for_image2(source, target, colors, verbose = True, group_threshold = GROUP_THRESHOLD,
+        strip = None, hooks = ()):
     """Clear background of source image.
     
     Result is a black and white image in png format. White color 
-    coresponds to foreground pixels, black color to background pixels."""
-    global errors
-    sourceTime = os.path.getmtime(source)
-    targetTime = os.path.getmtime(target) if os.path.exists(target) else 0
-    if sourceTime <= targetTime:
-        print "%s is up to date" % (source)
-        return 
+    coresponds to foreground pixels, black color to background pixels.
+    Groups of at most 'group_threshold' pixels are considered noise.
+    If 'strip' is given, the image is processed in strips of 'strip' rows
+    to save memory, the result is the same. Stages and counters are passed
+    to 'hooks', see instrument.Recorder.
+    Returns tuple (errors, record) where errors is number of errors and
+    record holds the stages and counters."""
     print "%s -> %s" % (source, target)
-    img = Image.open(source)
+    recorder = instrument.Recorder(source, hooks)
+    with recorder.stage("load"):
+        img = Image.open(source)
+        img.load()
     # compute mean color
     try:
-        analyzer = Analyzer(img, colors, verbose)
-        pixels, groups, indexes = analyzer.filter_background2(img, 20) 
-        analyzer.save_pixels(target, pixels)
+        analyzer = Analyzer(img, colors, verbose, recorder = recorder)
+        if strip:
+            strips = analyzer.filter_background_strips(img, group_threshold, strip)
+            analyzer.save_pixel_strips(target, strips)
+        else:
+            pixels, groups, indexes = analyzer.filter_background2(img, group_threshold)
+            analyzer.save_pixels(target, pixels)
     except AnalyzerError as e:
         print "Error: %s: %s" % (source, str(e))
-        errors = errors + 1
+        return 1, recorder.record(str(e))
+    return 0, recorder.record()
 
-def clear_background_for_directory(source, target, version, colors, verbose = False):
+def clear_background_for_directory(source, target, version, colors, verbose = False, jobs = 1,
+        strip = None, timings = None, hooks = ()):
     """Clear background of all images in the source directory.
     
     Result is a black and white image in png format. White color 
     coresponds to foreground pixels, black color to background pixels.
     One result file will be created in target directory for each image
     in the source directory. Base name of the source file will be appended
-    with .skel.png extension."""
+    with .skel.png extension. Images are processed by 'jobs' processes.
+    Version 2 processes images in strips of 'strip' rows if it is given.
+    Images whose result is up to date (see cache.py) are skipped.
+    If 'timings' is given, stages and counters of each processed image are
+    written into that file as JSON Lines, 'hooks' are called in the
+    processes that process the images, see instrument.py.
+    Returns number of errors."""
     # append folder separator if it is not present in source
     source_dir = source + os.path.sep if source[-1] != os.path.sep else source
     # append folder separator if it is not present in target
@@ -68,14 +98,26 @@ def clear_background_for_directory(source, target, version, colors, verbose = Fa
         filenames = os.listdir(source)
     except:
         print "Error: Falied to list directory '%s'" % (source)
-        return
+        return 1
+
+    if version == 1:
+        function = clear_background_for_image
+    elif version == 2:
+        function = clear_background_for_image2
+    else:
+        print "Unknown version '%d'." % (version)
+        return 1
+
+    # create target directory if it does not exist
+    if not os.path.exists(target_dir):
+        os.mkdir(target_dir)
 
+    manifest = cache.Manifest(target_dir)
+    code = cache.code_version("analyzer", "labeling")
+    tasks = []
+    outputs = []
     filenames.sort()
     for filename in filenames:
-        # create target directory if it does not exist
-        if not os.path.exists(target_dir):
-            os.mkdir(target_dir)
-
         # insert ".root" before extension of the target filename
         target_fn = os.path.splitext(filename)[0] + ".root.png"
         source_fn = filename
@@ -91,14 +133,36 @@ def clear_background_for_directory(source, target, version, colors, verbose = Fa
             ext = ext.lower()
             if ext in (".bmp", ".png", ".jpg", ".jpeg"):
                 # encountered image file
-                if version == 1:
-                    clear_background_for_image(source_path, 
-                            target_dir + target_fn, colors, verbose)
-                elif version == 2:
-                    clear_background_for_image2(source_path, 
-                            target_dir + target_fn, colors, verbose)
+                target_path = target_dir + target_fn
+                key = manifest.key([source_path], version, GROUP_THRESHOLD, colors, code)
+                if manifest.is_current(target_path, key):
+                    print "%s is up to date" % (source_path)
+                    continue
+                if version == 2:
+                    tasks.append((source_path, target_path, colors, verbose,
+                            GROUP_THRESHOLD, strip, hooks))
                 else:
-                    print "Unknown version '%d'." % (version)
+                    tasks.append((source_path, target_path, colors, verbose, hooks))
+                outputs.append((target_path, key))
+
+    errors = 0
+    # records of images that are not processed again are kept
+    log = instrument.open_records(timings, set(task[0] for task in tasks)) if timings else None
+    results = parallel.imap(function, tasks, jobs)
+    try:
+        for (target_path, key), (error, record) in itertools.izip(outputs, results):
+            if not error:
+                manifest.update(target_path, key)
+            errors += error
+            if log:
+                instrument.write_record(log, record)
+    finally:
+        if log:
+            log.close()
+        # images finished before an error or an interrupt are not processed
+        # again
+        manifest.save()
+    return errors
 
 if __name__=="__main__":
     # parse commandline arguments
@@ -107,9 +171,15 @@ if __name__=="__main__":
             
     parser.add_argument("source", type=str, help="source directory or file")
     parser.add_argument("target", type=str, help="target directory or file")
+    parser.add_argument("--jobs", type=int, default=1,
+            help="number of images processed in parallel, 0 means one for each CPU")
+    parser.add_argument("--strip", type=int, default=None,
+            help="process images in strips of given number of rows to save memory")
     arguments = parser.parse_args()
     source = arguments.source
     target = arguments.target
+    jobs = parallel.jobs_count(arguments.jobs)
+    strip = arguments.strip
 
     # run the script
     print "Running..."
@@ -117,10 +187,23 @@ if __name__=="__main__":
     if os.path.isdir(source):
         # source is a directory, clear background of all images in that
         # directory and save each result to separate file in target directory
-        clear_background_for_directory(source, target, 2, colors)
+        errors = clear_background_for_directory(source, target, 2, colors, jobs = jobs,
+                strip = strip, timings = os.path.join(target, TIMINGS))
     else:
         # source is a file, clear background of that image
-        clear_background_for_image2(source, target, colors)
+        manifest = cache.Manifest(os.path.dirname(os.path.abspath(target)))
+        key = manifest.key([source], 2, GROUP_THRESHOLD, colors,
+                cache.code_version("analyzer", "labeling"))
+        if manifest.is_current(target, key):
+            print "%s is up to date" % (source)
+            errors = 0
+        else:
+            errors, record = clear_background_for_image2(source, target, colors, strip = strip)
+            if not errors:
+                manifest.update(target, key)
+            manifest.save()
+            with open(instrument.timings_path(target), "w") as f:
+                instrument.write_record(f, record)
     if errors > 0:
         print "Warning: There were %d errors in skeleton examination." % (errors)
     print "Finished."
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+import argparse
+import os
+
+from PIL import Image
+from analyzer import Analyzer, AnalyzerError, load_colors
+from results import MeasurementsWriter, list_images, measure_images
+import cache
+import estimators
+import instrument
+import parallel
+from store import ResultsStore
+
+# modules whose code affects the measurements
+CODE = ("analyzer", "labeling", "thinning", "topology", "graph", "estimators")
+
+def analyze_image(source, target, dpi, colors, debug = None, verbose = True,
+        estimator = estimators.DEFAULT, hooks = ()):
+    """Measure colored root stored in image file 'source'.
+
+    Background of the image is removed, root is thinned into a skeleton
+    and the skeleton is measured, all in memory. Colorized skeleton is
+    saved into file 'target'. If 'debug' is given, black and white root
+    and skeleton are saved into files 'debug'.root.png and 'debug'.skel.png.
+    Stages and counters of the analysis are passed to 'hooks', see
+    instrument.Recorder.
+
+    Returns tuple (data, errors, record) where data is a list of measured
+    sections of the root, errors is number of errors and record holds the
+    stages and counters of the analysis. Lengths are in milimeters."""
+    print "%s -> %s" % (source, target)
+    recorder = instrument.Recorder(source, hooks)
+    with recorder.stage("load"):
+        img = Image.open(source)
+        img.load()
+    data = []
+    try:
+        analyzer = Analyzer(img, colors, verbose, estimator, recorder)
+        pixels, data = analyzer.analyze(img, dpi, debug = debug)
+        analyzer.save_pixels(target, pixels, "RGB")
+    except AnalyzerError as e:
+        print "Error: %s: %s" % (source, str(e))
+        return data, 1, recorder.record(str(e))
+    return data, 0, recorder.record()
+
+def analyze_directory(source, target, dpi, colors, debug = None, verbose = False, jobs = 1,
+        estimator = estimators.DEFAULT, timings = None, hooks = (), writer = None):
+    """Measure colored roots stored in images in directory 'source'.
+
+    Colorized skeletons are saved into directory 'target' with extension
+    .cols.png. If 'debug' directory is given, black and white roots and
+    skeletons are saved there with extensions .root.png and .skel.png.
+
+    Images are processed by 'jobs' processes. Images whose results are up
+    to date (see cache.py) are not measured again. If 'timings' is given,
+    stages and counters of each measured image are written into that file
+    as JSON Lines. 'hooks' are called in the processes that measure the
+    images, so they must be defined at module level, see instrument.py.
+
+    If 'writer' is given (see results.MeasurementsWriter), results of each
+    image are written by it as soon as the image is measured and images
+    that are already complete in it are skipped. Otherwise results of all
+    images are returned.
+
+    Returns tuple (results, errors). One result contains name of the image
+    without extension, color and length of a section of the root. Errors is
+    number of errors. Results are empty if 'writer' is given."""
+    # append folder separator if it is not present in folder names
+    source_dir = source + os.path.sep if source[-1] != os.path.sep else source
+    target_dir = target + os.path.sep if target[-1] != os.path.sep else target
+    if debug:
+        debug = debug + os.path.sep if debug[-1] != os.path.sep else debug
+
+    # make target directories if they do not exist
+    for directory in (target_dir, debug):
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # get list of images in the source directory
+    try:
+        sources = list_images(source_dir)
+    except OSError:
+        print "Falied to list directory '%s'" % (source)
+        return [], 1
+
+    images = [] # (name, sources, target path, task)
+    for base, source_path in sources:
+        target_path = target_dir + base + ".cols.png"
+        images.append((base, [source_path], target_path, (source_path,
+                target_path, dpi, colors, debug + base if debug else None,
+                verbose, estimator, hooks)))
+    # debug images are not tracked, with debug output everything runs
+    return measure_images(analyze_image, images, target_dir,
+            (dpi, colors, estimator, cache.code_version(*CODE)), jobs,
+            timings, writer, force = bool(debug))
+
+if __name__=="__main__":
+    # parse commandline arguments
+    parser = argparse.ArgumentParser(
+            description="Measure colored root in given image or of all images in given directory.")
+    parser.add_argument("images", type=str, help="source directory or file with colored roots")
+    parser.add_argument("target", type=str, help="target directory or file where colored skeletons will be saved")
+    parser.add_argument("stats", type=str, help="file where measurements will be saved")
+    parser.add_argument("--debug", type=str, default=None,
+            help="directory where black and white roots and skeletons will be saved")
+    parser.add_argument("--jobs", type=int, default=1,
+            help="number of images processed in parallel, 0 means one for each CPU")
+    parser.add_argument("--estimator", choices=sorted(estimators.ESTIMATORS),
+            default=estimators.DEFAULT, help="estimator of length of the skeleton")
+    parser.add_argument("--resume", action="store_true",
+            help="continue measurements in an existing stats file, images already in it are skipped")
+    parser.add_argument("--database", type=str, default=None,
+            help="SQLite database where measurements will be saved too, see query-results.py")
+    parser.add_argument("--experiment", type=str, default=None,
+            help="name of the experiment in the database, name of the stats file by default")
+    arguments = parser.parse_args()
+    images = arguments.images
+    target = arguments.target
+    stats = arguments.stats
+    debug = arguments.debug
+    jobs = parallel.jobs_count(arguments.jobs)
+    estimator = arguments.estimator
+    dpi = 300
+
+    # run the script
+    print "Running..."
+    colors = load_colors()
+    # stats file may be in a target directory that does not exist yet
+    directory = os.path.dirname(os.path.abspath(stats))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    timings = instrument.timings_path(stats)
+    store = None
+    if arguments.database:
+        experiment = arguments.experiment
+        if experiment is None:
+            experiment = os.path.splitext(os.path.basename(stats))[0]
+        store = ResultsStore(arguments.database, experiment, cache.parameters_digest(
+                dpi, colors, estimator, cache.code_version(*CODE)))
+    if os.path.isdir(images):
+        with MeasurementsWriter(stats, colors, arguments.resume, store) as writer:
+            data, errors = analyze_directory(images, target, dpi, colors, debug, jobs = jobs,
+                    estimator = estimator, timings = timings, writer = writer)
+    else:
+        if debug:
+            if not os.path.exists(debug):
+                os.makedirs(debug)
+            debug = os.path.join(debug, os.path.splitext(os.path.basename(images))[0])
+        data, errors, record = analyze_image(images, target, dpi, colors, debug,
+                estimator = estimator)
+        with open(timings, "w") as f:
+            instrument.write_record(f, record)
+        with MeasurementsWriter(stats, colors, store = store) as writer:
+            writer.write(0, data, os.path.splitext(os.path.basename(images))[0])
+    if store:
+        store.close()
+    if errors > 0:
+        print "Warning: There were %d errors in skeleton examination." % (errors)
+    print "Finished."
@@ -4,38 +4,52 @@ import os
 
 from PIL import Image, ImageColor
 from analyzer import Analyzer, AnalyzerError, load_colors
-
-errors = 0
-
-def measure_skeleton_for_image(source, skeleton, target, dpi, colors, verbose = True):
+from results import MeasurementsWriter, list_images, measure_images
+import cache
+import estimators
+import instrument
+import parallel
+from store import ResultsStore
+
+# modules whose code affects the measurements
+CODE = ("analyzer", "labeling", "topology", "graph", "estimators")
+
+def measure_skeleton_for_image(source, skeleton, target, dpi, colors, verbose = True,
+        estimator = estimators.DEFAULT, hooks = ()):
     """Measure skeleton stored in a bitmap image in file 'source'.
     
     Image must be black and white. Background must be black, skeleton must
     be white. All pixels of the skeleton must be connected together into a
-    single skeleton.
+    single skeleton. Stages and counters of the measurement are passed to
+    'hooks', see instrument.Recorder.
     
-    Returns list containing filename, length of the skeleton and number 
-    of branches. Length is in milimeters."""
-    global errors
+    Returns tuple (data, errors, record) where data is a list containing
+    filename, length of the skeleton and number of branches, errors is
+    number of errors and record holds the stages and counters of the
+    measurement. Length is in milimeters."""
     print "%s -> %s" % (skeleton, target)
-    img = Image.open(source)
-    skel = Image.open(skeleton)
+    recorder = instrument.Recorder(skeleton, hooks)
+    with recorder.stage("load"):
+        img = Image.open(source)
+        skel = Image.open(skeleton)
+        img.load()
+        skel.load()
     if img.size == skel.size:
         data = []
         try:
-            analyzer = Analyzer(img, colors, verbose)
+            analyzer = Analyzer(img, colors, verbose, estimator, recorder)
             pixels, data = analyzer.measure_skeleton(img, skel, dpi)
             analyzer.save_pixels(target, pixels, "RGB")
         except AnalyzerError as e:
             print "Error: %s: %s" % (skeleton, str(e))
-            errors = errors + 1
-        return data
+            return data, 1, recorder.record(str(e))
+        return data, 0, recorder.record()
     else:
         print "Error: Images '%s' and '%s' do not have the same sizes!" % (source, skeleton)
-        errors = errors + 1
-        return {}
+        return [], 1, recorder.record("Images do not have the same sizes.")
 
-def measure_skeleton_for_directory(source, skeleton, target, dpi, colors, verbose = False):
+def measure_skeleton_for_directory(source, skeleton, target, dpi, colors, verbose = False, jobs = 1,
+        estimator = estimators.DEFAULT, timings = None, hooks = (), writer = None):
     """Measure skeletons stored in a bitmap images in directory 'source'.
     
     Images must be black and white. Background must be black, skeleton must
@@ -45,9 +59,21 @@ def measure_skeleton_for_directory(source, skeleton, target, dpi, colors, verbos
     Only those images are measured whose filename ends with .skel.png.
     Other files are ignored.
 
-    Returns list of results. One result contains filename, length of the 
-    skeleton and number of branches. Filename is without the skel.png 
-    extension, length is in milimeters."""
+    Images are processed by 'jobs' processes. Images whose results are up
+    to date (see cache.py) are not measured again. If 'timings' is given,
+    stages and counters of each measured image are written into that file
+    as JSON Lines. 'hooks' are called in the processes that measure the
+    images, so they must be defined at module level, see instrument.py.
+
+    If 'writer' is given (see results.MeasurementsWriter), results of each
+    image are written by it as soon as the image is measured and images
+    that are already complete in it are skipped. Otherwise results of all
+    images are returned.
+
+    Returns tuple (results, errors). One result contains filename, length
+    of the skeleton and number of branches. Filename is without the skel.png
+    extension, length is in milimeters. Errors is number of errors. Results
+    are empty if 'writer' is given."""
     # append folder separator if it is not present in folder names
     source_dir = source + os.path.sep if source[-1] != os.path.sep else source
     skeleton_dir = skeleton + os.path.sep if skeleton[-1] != os.path.sep else skeleton
@@ -55,81 +81,28 @@ def measure_skeleton_for_directory(source, skeleton, target, dpi, colors, verbos
 
     # make target directry if it does not exist
     if not os.path.exists(target_dir):
-        os.path.makedirs(target_dir)
+        os.makedirs(target_dir)
 
-    # get list of files in the source directory
-    try: 
-        filenames = []
-        filenames = os.listdir(source)
-    except:
+    # get list of images in the source directory
+    try:
+        sources = list_images(source_dir)
+    except OSError:
         print "Falied to list directory '%s'" % (source)
-        return {}
-
-    measurements = []
-    filenames.sort()
-    for filename in filenames:
-        base = os.path.splitext(filename)[0]
-        ext = os.path.splitext(filename)[1]
-        # see if the source file is in supported format and if so, analyze it
-        source_fn = filename
-        source_path = source_dir + source_fn
+        return [], 1
+
+    images = [] # (name, sources, target path, task)
+    for base, source_path in sources:
         skeleton_path = skeleton_dir + base + ".skel.png"
         target_path = target_dir + base + ".cols.png"
-        if (os.path.isfile(source_path)
-                and ext in [".bmp", ".png", ".jpg", ".jpeg"]
-                and not source_fn.endswith(".root.png")
-                and not source_fn.endswith(".skel.png")
-                and not source_fn.endswith(".cols.png")
-                and os.path.isfile(skeleton_path)):
+        if os.path.isfile(skeleton_path):
             # encountered image file that has a coresponding skeleton file
-            data = measure_skeleton_for_image(source_path, skeleton_path, 
-                    target_path, dpi, colors, verbose)
-            name = os.path.split(source_path)[1] # remove folder name
-            name = os.path.splitext(name)[0] # remove format extension
-            name = os.path.splitext(name)[0] # remove skel extension
-            for d in data:
-                d["jmeno"] = name
-            measurements = data + measurements # files will be ordered alphabetically in the csv
-    return measurements
-
-def save_skeleton_measurements(data, target):
-    """Saves result of the measurement into the target file.
-    
-    Format of the file is csv. Each element in the data will be saved
-    into one line. Elements of the data will be separated by colons.
-    The first line contains header."""
-    data.reverse()
-    errors = 0 # number of errors
-    with open(target, 'w') as f:
-        # this specifies which columns will be written out and in which order
-        leading_headers = [
-                "jmeno",
-                "barva",
-                "delka"
-                ]
-        other_headers = [
-                "%s" % (c[0]) for c in colors
-                ]
-        other_headers.append("bila")
-        headers = leading_headers + other_headers
-        f.write(";".join(headers)+"\n")
-        #print data
-        for row in data:
-            records = []
-            for column in headers:
-                record = row[column] if row.has_key(column) else 0
-                if type(record) == int:
-                    record = "%d" % (record)
-                elif type(record) == float:
-                    record = "%0.4f" % (record)
-                elif type(record) == str:
-                    pass
-                else:
-                    print "Error: Unexpected type '%s' of value '%s'. Allowed are int, float and str." % (type(record), record)
-                    record = str(record)
-                records.append(record)
-            f.write(";".join(records)+"\n")
-
+            name = os.path.splitext(base)[0] # remove skel extension
+            images.append((name, [source_path, skeleton_path], target_path,
+                    (source_path, skeleton_path, target_path, dpi, colors,
+                    verbose, estimator, hooks)))
+    return measure_images(measure_skeleton_for_image, images, target_dir,
+            (dpi, colors, estimator, cache.code_version(*CODE)), jobs,
+            timings, writer)
 
 if __name__=="__main__":
     # parse commandline arguments
@@ -139,22 +112,53 @@ if __name__=="__main__":
     parser.add_argument("skeletons", type=str, help="source directory or file with skeletons")
     parser.add_argument("target", type=str, help="target directory or file where colored skeletons will be saved")
     parser.add_argument("stats", type=str, help="file where measurements will be saved")
+    parser.add_argument("--jobs", type=int, default=1,
+            help="number of images processed in parallel, 0 means one for each CPU")
+    parser.add_argument("--estimator", choices=sorted(estimators.ESTIMATORS),
+            default=estimators.DEFAULT, help="estimator of length of the skeleton")
+    parser.add_argument("--resume", action="store_true",
+            help="continue measurements in an existing stats file, images already in it are skipped")
+    parser.add_argument("--database", type=str, default=None,
+            help="SQLite database where measurements will be saved too, see query-results.py")
+    parser.add_argument("--experiment", type=str, default=None,
+            help="name of the experiment in the database, name of the stats file by default")
     arguments = parser.parse_args()
     images = arguments.images
     skeletons = arguments.skeletons
     target = arguments.target
     stats = arguments.stats
+    jobs = parallel.jobs_count(arguments.jobs)
+    estimator = arguments.estimator
     dpi = 300
 
     # run the script
     print "Running..."
     colors = load_colors()
+    # stats file may be in a target directory that does not exist yet
+    directory = os.path.dirname(os.path.abspath(stats))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    timings = instrument.timings_path(stats)
+    store = None
+    if arguments.database:
+        experiment = arguments.experiment
+        if experiment is None:
+            experiment = os.path.splitext(os.path.basename(stats))[0]
+        store = ResultsStore(arguments.database, experiment, cache.parameters_digest(
+                dpi, colors, estimator, cache.code_version(*CODE)))
     if os.path.isdir(images):
-        data = measure_skeleton_for_directory(images, skeletons, target, dpi, colors)
-        save_skeleton_measurements(data, stats)
+        with MeasurementsWriter(stats, colors, arguments.resume, store) as writer:
+            data, errors = measure_skeleton_for_directory(images, skeletons, target, dpi, colors,
+                    jobs = jobs, estimator = estimator, timings = timings, writer = writer)
     else:
-        data = measure_skeleton_for_image(images, skeletons, target, dpi, colors)
-        save_skeleton_measurements(data, stats)
+        data, errors, record = measure_skeleton_for_image(images, skeletons, target, dpi, colors,
+                estimator = estimator)
+        with open(timings, "w") as f:
+            instrument.write_record(f, record)
+        with MeasurementsWriter(stats, colors, store = store) as writer:
+            writer.write(0, data, os.path.splitext(os.path.basename(images))[0])
+    if store:
+        store.close()
     if errors > 0:
         print "Warning: There were %d errors in skeleton examination." % (errors)
     print "Finished."
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+import argparse
+import itertools
+import os
+
+import numpy
+from PIL import Image
+import thinning
+import cache
+import parallel
+
+def skeletonize_image(source, target):
+    """Compute skeleton of a root in source image.
+
+    Source image must be black and white, root must be white and background
+    must be black. Result is a black and white image in png format where
+    the skeleton is white and one pixel thick. Returns number of errors."""
+    print "%s -> %s" % (source, target)
+    try:
+        img = Image.open(source).convert("L")
+    except IOError as e:
+        print "Error: %s: %s" % (source, str(e))
+        return 1
+    mask = numpy.asarray(img) >= 128
+    skeleton = thinning.skeletonize(mask)
+    Image.fromarray(skeleton * numpy.uint8(255)).save(target)
+    return 0
+
+def skeletonize_directory(source, target, jobs = 1):
+    """Compute skeletons of all roots in the source directory.
+
+    Only files with extension .root.png are processed, other files are
+    ignored. One result file will be created in target directory for each
+    image in the source directory. The .root.png extension of the source
+    file will be replaced with .skel.png extension. Images are processed
+    by 'jobs' processes. Images whose skeleton is up to date (see cache.py)
+    are skipped. Returns number of errors."""
+    # append folder separator if it is not present in source
+    source_dir = source + os.path.sep if source[-1] != os.path.sep else source
+    # append folder separator if it is not present in target
+    target_dir = target + os.path.sep if target[-1] != os.path.sep else target
+
+    try: 
+        filenames = []
+        filenames = os.listdir(source)
+    except:
+        print "Error: Falied to list directory '%s'" % (source)
+        return 1
+
+    sources = []
+    filenames.sort()
+    for filename in filenames:
+        source_path = source_dir + filename
+        if os.path.isfile(source_path) and filename.endswith(".root.png"):
+            target_fn = filename[:-len("root.png")] + "skel.png"
+            sources.append((source_path, target_dir + target_fn))
+    if not sources:
+        print "No files ending .root.png found."
+        return 0
+    # create target directory if it does not exist
+    if not os.path.exists(target_dir):
+        os.mkdir(target_dir)
+
+    manifest = cache.Manifest(target_dir)
+    code = cache.code_version("thinning")
+    tasks = []
+    outputs = []
+    for source_path, target_path in sources:
+        key = manifest.key([source_path], code)
+        if manifest.is_current(target_path, key):
+            print "%s is up to date" % (source_path)
+            continue
+        tasks.append((source_path, target_path))
+        outputs.append((target_path, key))
+
+    errors = 0
+    results = parallel.imap(skeletonize_image, tasks, jobs)
+    for (target_path, key), error in itertools.izip(outputs, results):
+        if not error:
+            manifest.update(target_path, key)
+        errors += error
+    manifest.save()
+    return errors
+
+if __name__=="__main__":
+    # parse commandline arguments
+    parser = argparse.ArgumentParser(
+            description="Compute skeleton of a root in given image or of all roots in given directory.")
+            
+    parser.add_argument("source", type=str, help="source directory or file with black and white roots")
+    parser.add_argument("target", type=str, help="target directory or file")
+    parser.add_argument("--jobs", type=int, default=1,
+            help="number of images processed in parallel, 0 means one for each CPU")
+    arguments = parser.parse_args()
+    source = arguments.source
+    target = arguments.target
+    jobs = parallel.jobs_count(arguments.jobs)
+
+    # run the script
+    print "Running..."
+    if os.path.isdir(source):
+        errors = skeletonize_directory(source, target, jobs)
+    else:
+        errors = skeletonize_image(source, target)
+    if errors > 0:
+        print "Warning: There were %d errors in skeleton computation." % (errors)
+    print "Finished."
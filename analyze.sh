@@ -1,7 +1,7 @@
 #!/bin/bash
 if [ $# -lt 2 ]; then
   echo "Error: Missing arguments:"
-  echo "usage: analyze.sh DIRECTORY SHORTCUT [1|2|3]"
+  echo "usage: analyze.sh DIRECTORY SHORTCUT [1|2|3|4]"
   exit 1
 fi
 
@@ -9,6 +9,14 @@ fi
 DIRECTORY=$1
 SHORTCUT=$2
 COMMAND=$3
+# number of images processed in parallel, 0 means one for each CPU
+JOBS=${JOBS:-1}
+# SQLite database where measurements are saved too, none by default
+DATABASE=${DATABASE:-}
+STORE=${DATABASE:+--database $DATABASE --experiment $SHORTCUT}
+# program that computes skeletons, python (analyze-thinning.py) by default,
+# fiji uses skeleton.ijm
+SKELETONIZE=${SKELETONIZE:-python}
 
 # folders
 BMP=${DIRECTORY}/${SHORTCUT}colored-roots/
@@ -17,9 +25,14 @@ SKEL=${DIRECTORY}/${SHORTCUT}skeletons/
 COLS=${DIRECTORY}/${SHORTCUT}colored-skeletons/
 
 # commands
-C1="python analyze-background.py $BMP $ROOT"
-C2="fiji -batch skeleton.ijm $ROOT:$SKEL"
-C3="python analyze-skeleton.py $BMP $SKEL $COLS $COLS${SHORTCUT}barevnekostry.csv"
+C1="python analyze-background.py --jobs $JOBS $BMP $ROOT"
+if [ "$SKELETONIZE" = fiji ] ; then
+	C2="fiji -batch skeleton.ijm $ROOT:$SKEL"
+else
+	C2="python analyze-thinning.py --jobs $JOBS $ROOT $SKEL"
+fi
+C3="python analyze-skeleton.py --jobs $JOBS $STORE $BMP $SKEL $COLS $COLS${SHORTCUT}barevnekostry.csv"
+C4="python analyze-root.py --jobs $JOBS $STORE $BMP $COLS $COLS${SHORTCUT}barevnekostry.csv"
 
 if [ $COMMAND ] ; then
 	# if the third argument was provided, run only specific script
@@ -27,7 +40,8 @@ if [ $COMMAND ] ; then
 		1) $C1 ;;
 		2) $C2 ;;
 		3) $C3 ;;
-	    *) echo Error: Third argument must be one of numbers 1, 2 or 3.; exit 1;;
+		4) $C4 ;;
+	    *) echo Error: Third argument must be one of numbers 1, 2, 3 or 4.; exit 1;;
 	esac
 else
 	# if the third argument was not provided run all scripts
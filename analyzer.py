@@ -1,9 +1,20 @@
-import math
+import itertools
 from collections import deque
 import colorsys # for rgb_to_hsv, rgb_to_yiq
 from PIL import Image, ImageColor
 import operator
 from collections import defaultdict
+import numpy
+import labeling
+import thinning
+import topology
+import graph
+import estimators
+import instrument
+from pngwriter import PngWriter
+
+# images with more pixels are written in strips of rows to save memory
+STREAM_PIXELS = 1 << 24
 
 class AnalyzerError (Exception):
     def __init__(self, text):
@@ -54,9 +65,9 @@ class Coordinates:
         #return self._coords[index]
 
 class Neighbours:
-    """List of neighbours of each pixel.
-    
-    Neighbours can be accessed by x, y coordinates or by index of the pixel.
+    """Neighbours of each pixel, either four direct neighbours or all eight
+    neighbours.
+
     Top left pixel has index 0, bottom right pixel has index width * height - 1
     and top right pixel has index widht - 1."""
 
@@ -66,200 +77,266 @@ class Neighbours:
         # image
         self._coords = coords
         self._eight = eight
-
-        # generate lists of neighbours for each pixel
-        # list of neighbours represented as coordinates
-        #self._neigh_c = [self._generate(i, eight) 
-        #                    for i in xrange(coords.total())]
-        # list of neighbours represented as indexes
-        #self._neigh_i = [[self._coords.coord_to_index(c) for c in n]
-        #                    for n in self._neigh_c]
-
-    def _generate(self, index, eight):
-        """Generate list of coordinates of a pixel with index 'index'."""
-        w = self._coords.width()
-        h = self._coords.height()
-        x, y = self._coords.index_to_coord(index)
-        if eight:
-            # generate all eight neighbours (even invalid ones)
-            n = [   
-                    (x - 1, y - 1),
-                    (x    , y - 1),
-                    (x + 1, y - 1),
-                    (x - 1, y    ),
-                    (x + 1, y    ),
-                    (x - 1, y + 1),
-                    (x    , y + 1),
-                    (x + 1, y + 1)
-                ]
-        else:
-            # generate all four neighbours (even invalid ones)
-            n = [   
-                    (x    , y - 1),
-                    (x - 1, y    ),
-                    (x + 1, y    ),
-                    (x    , y + 1)
-                ]
-
-        # filter out invalid neighbours
-        n2 = ((x, y) for x, y in n if x >= 0 and x < w and y >= 0 and y < h)
-        return n2
-
-    def neighs_as_indexes(self, pixel):
-        if type(pixel) == tuple:
-            return (self._coords.coord_to_index(c) for c in 
-                    self.neighs_as_coords(self._coords.coord_to_index(pixel)))
-            #return self._neigh_i[self._coords.coord_to_index(pixel)]
-        else:
-            return (self._coords.coord_to_index(c) for c in self.neighs_as_coords(pixel))
-            #return self._neigh_i[pixel]
-    
-    def neighs_as_coords(self, pixel):
-        if type(pixel) == tuple:
-            return self._generate(self._coords.coord_to_index(pixel), self._eight)
-            #return self._neigh_c[self._coords.coord_to_index(pixel)]
+        # flat offsets of neighbours for each neighbourhood code, the codes
+        # never contain neighbours outside of the image (see topology.py)
+        self._offsets = topology.offsets(coords.width(), eight)
+
+    def eight(self):
+        """Return True if all eight neighbours are generated."""
+        return self._eight
+
+    def offsets(self):
+        """Return table of offsets of neighbours indexed by neighbourhood
+        codes, neighbours go top to bottom and left to right."""
+        return self._offsets
+
+class Palette(list):
+    """List of named colors of roots, items are (name, (r, g, b)) tuples.
+
+    Colors are numbered from 1 in the order of the list, number 0 means
+    that a color does not belong to the palette. A lookup table maps every
+    24 bit color to the number of the palette color it belongs to. A color
+    belongs to a palette color if none of its channels differs by more than
+    the tolerance of the palette color. If a color is close to more palette
+    colors, it belongs to the closest one."""
+
+    def __init__(self, colors, tolerances = None):
+        list.__init__(self, colors)
+        self._tolerances = list(tolerances) if tolerances else [0] * len(self)
+        self._table = None # created on first use, it takes 16 MB
+
+    def __repr__(self):
+        return "Palette(%s, %s)" % (list.__repr__(self), repr(self._tolerances))
+
+    def __getstate__(self):
+        # the lookup table is too big to be sent to other processes
+        state = self.__dict__.copy()
+        state["_table"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def names(self):
+        """Return list of names indexed by numbers of colors. Number 0 is
+        white ("bila")."""
+        return ["bila"] + [name for name, color in self]
+
+    def find(self, *names):
+        """Return number of color with the first of given names that exists
+        in the palette or 0."""
+        for name in names:
+            for number, (n, c) in enumerate(self, 1):
+                if n == name:
+                    return number
+        return 0
+
+    def to_rgb(self, numbers):
+        """Convert numbers of colors into array of (r, g, b) colors. Number 0
+        is white."""
+        table = numpy.array([(255, 255, 255)] + [c for n, c in self],
+                dtype=numpy.uint8)
+        if not isinstance(numbers, numpy.ndarray):
+            numbers = numpy.frombuffer(numbers, dtype=numpy.uint8)
+        return table[numbers]
+
+    def table(self):
+        """Return lookup table that maps 24 bit colors (0xrrggbb) to numbers
+        of palette colors."""
+        if self._table is None:
+            table = numpy.zeros(1 << 24, dtype=numpy.uint8)
+            # distance of each color to the closest palette color
+            distances = numpy.empty(1 << 24, dtype=numpy.uint8)
+            distances.fill(255)
+            for number, ((name, color), tolerance) in enumerate(
+                    zip(self, self._tolerances), 1):
+                channels = [numpy.arange(max(c - tolerance, 0),
+                                min(c + tolerance, 255) + 1) for c in color]
+                r, g, b = [ch.reshape(shape) for ch, shape in zip(channels,
+                                ((-1, 1, 1), (1, -1, 1), (1, 1, -1)))]
+                codes = ((r << 16) | (g << 8) | b).ravel()
+                distance = numpy.maximum(numpy.maximum(abs(r - color[0]),
+                            abs(g - color[1])), abs(b - color[2])).ravel()
+                # earlier colors win if the distance is the same
+                closer = distance < distances[codes]
+                table[codes[closer]] = number
+                distances[codes[closer]] = distance[closer]
+            self._table = table
+        return self._table
+
+    def classify(self, img, indexes = None):
+        """Return flat array with number of palette color of each pixel of
+        image 'img'.
+
+        If 'indexes' are given, only pixels with these flat indexes are
+        classified and the array holds their numbers in the same order.
+        Only the bounding box of these pixels is converted to RGB."""
+        if indexes is None:
+            rgb = _image_array(img, "RGB").reshape(-1, 3)
         else:
-            return self._generate(pixel, self._eight)
-            #return self._neigh_c[pixel]
-
-class Crossroad:
-    def __init__(self, index, branch):
-        self._index = index
-        self._branches = [branch]
-        branch.end(self)
-
-    def append(self, branch):
-        self._branches.append(branch)
-
-    def get_index(self):
-        return self._index
-
-    def get_branches(self, branch = None):
-        # get other branches than branch
-        return filter(lambda b: b != branch, self._branches)
-    
-    def get_branch(self, index):
-        return self._branches[index]
-
-class Branch:
-    def __init__(self, crossroad):
-        self._start = crossroad
-        self._end = None
-        self._indexes = []
-
-    def end(self, crossroad):
-        self._end = crossroad
-        self._indexes.pop()
-
-    def append(self, index):
-        self._indexes.append(index)
-
-    def get_crossroad(self, crossroad = None):
-        # return the crossroad opposite to given crossroad
-        return self._end if crossroad == self._start else self._start
-
-    def get_first_index(self, crossroad = None):
-        if crossroad == self._start:
-            return self._indexes[0] if self._indexes else self._end.get_index()
-        else:
-            return self._indexes[-1] if self._indexes else self._start.get_index()
-
-    def get_last_index(self):
-        return self._indexes[-1]
-
-    def get_indexes(self, crossroad = None):
-        # get indexes starting from given crossroad
-        return iter(self._indexes) if crossroad == self._start else reversed(self._indexes)
-
+            if not len(indexes):
+                return numpy.zeros(0, dtype=numpy.uint8)
+            y, x = numpy.divmod(indexes, img.size[0])
+            box = (int(x.min()), int(y.min()), int(x.max()) + 1, int(y.max()) + 1)
+            rgb = numpy.asarray(img.crop(box).convert("RGB"))
+            rgb = rgb[y - box[1], x - box[0]]
+        # 24 bit codes of colors, computed in place in one array
+        codes = rgb[:, 0].astype(numpy.uint32)
+        codes <<= 8
+        codes |= rgb[:, 1]
+        codes <<= 8
+        codes |= rgb[:, 2]
+        return self.table()[codes]
 
 class Analyzer:
-    def __init__(self, img, colors = None, verbose = False):
+    def __init__(self, img, colors = None, verbose = False,
+            estimator = estimators.DEFAULT, recorder = None):
+        if estimator not in estimators.ESTIMATORS:
+            raise AnalyzerError("Unknown length estimator '%s'." % (estimator))
         self._verbose = verbose
+        # stages and counters of the analysis, see instrument.py
+        self._recorder = recorder if recorder is not None else instrument.Recorder()
+        self._estimator = estimator
         self._coords = Coordinates(img.size)
         self._neigh4 = Neighbours(self._coords, False)
         self._neigh8 = Neighbours(self._coords, True)
+        if colors is not None and not isinstance(colors, Palette):
+            colors = Palette(colors)
         self._colors = colors
+        self._names = colors.names() if colors is not None else ["bila"]
+
+    def recorder(self):
+        """Return Recorder of stages and counters of the analysis."""
+        return self._recorder
     
     def filter_background(self, img, 
             color_threshold = 180, group_threshold = 5):
         # light colors will be marked as background
-        img = img.getdata()
-        pixels = [0 if c > color_threshold else 1 for c in img]
+        with self._recorder.stage("threshold"):
+            pixels = (_image_array(img, "L") <= color_threshold).view(numpy.uint8)
         # assign each pixel a group number, group is a continuous section
         # of background or foreground pixels
-        groups, indexes = self._groups_init(pixels, self._neigh4)
-        while min((len(g) for g in indexes)) <= group_threshold:
-            groups, indexes = self._groups_prune(pixels, groups, indexes, 
-                    self._neigh4, group_threshold)
+        groups, indexes = self._groups_prune(pixels, self._neigh4,
+                group_threshold)
 
         return pixels, groups, indexes
     
     def filter_background2(self, img, group_threshold = 5):
-        # light colors will be marked as background
-        colors = [record[1] for record in self._colors]
-        img = img.getdata()
-        pixels = [1 if c in colors else 0 for c in img]
+        # colors outside of the palette will be marked as background
+        with self._recorder.stage("classify"):
+            pixels = self._colors.classify(img)
+            numpy.minimum(pixels, 1, out=pixels)
         # assign each pixel a group number, group is a continuous section
         # of background or foreground pixels
-        groups, indexes = self._groups_init(pixels, self._neigh4)
-        while min((len(g) for g in indexes)) <= group_threshold:
-            groups, indexes = self._groups_prune(pixels, groups, indexes, 
-                    self._neigh4, group_threshold)
+        groups, indexes = self._groups_prune(pixels, self._neigh4,
+                group_threshold)
 
         return pixels, groups, indexes
 
-    def _measure_colors(self, branch, crossroad, pixels, dpi, record, direct, diagonal):
+    def filter_background_strips(self, img, group_threshold = 5, strip = 1024):
+        """Same as filter_background2() but the image is processed in strips
+        of 'strip' rows.
+
+        Only one strip of pixels and sizes and neighbours of the groups are
+        held in memory, see labeling.prune_strips(). Returns generator of
+        strips of the final pixels, each strip is an array with one row of
+        the image in each row. Pixels are the same as filter_background2()
+        returns."""
+        width, height = img.size
+        def read(top, bottom):
+            # colors outside of the palette will be marked as background
+            pixels = self._colors.classify(img.crop((0, top, width, bottom)))
+            numpy.minimum(pixels, 1, out=pixels)
+            return pixels.reshape(bottom - top, width)
+        self._print("Prunning groups in strips of %d rows." % (strip))
+        self._recorder.count("pixels", width * height)
+        with self._recorder.stage("prune"):
+            strips, pruned, rounds = labeling.prune_strips(read, height,
+                    group_threshold, strip, self._neigh4.eight())
+        self._recorder.count("pruned", pruned)
+        self._recorder.count("prune_rounds", rounds)
+        self._print("Pruned %d groups." % (pruned))
+        return strips
+
+    def skeletonize(self, pixels):
+        """Thin foreground pixels into a one pixel thick skeleton.
+
+        Returns flat uint8 array of pixels where skeleton pixels are 1 and
+        all other pixels are 0."""
+        self._print("Computing skeleton.")
+        mask = numpy.asarray(pixels, dtype=numpy.uint8).reshape(
+                self._coords.height(), self._coords.width())
+        with self._recorder.stage("skeletonize"):
+            return thinning.skeletonize(mask).ravel()
+
+    def _measure_colors(self, skeleton, pixels, dpi):
         """Measures total length of the skeleton in the image 'img'.
         
+        Skeleton is walked from the begining of the root, branches are
+        kept on a stack so there is no limit on the depth of the skeleton.
+        Steps along each branch are counted from its chain code, see
+        estimators.py.
         Returns various statistics of the skeleton. Lengths are in milimeters. """
         data = []
-
-        previous = crossroad.get_index() if crossroad else None
-        if not record:
-            record = defaultdict(int)
-            if previous:
-                record[self._get_color_name(pixels[previous])] += 1
-            else:
-                record[self._get_color_name(None)] += 1
+        # (branch, crossroad it is entered from, record, direct steps,
+        # diagonal steps, corners, code of the last step)
+        stack = [(0, graph.NONE, None, 0, 0, 0, None)]
+        while stack:
+            edge, node, record, direct, diagonal, corners, last = stack.pop()
+            previous = skeleton.node_pixel(node) if node != graph.NONE else None
+            if not record:
+                record = defaultdict(int)
+                if previous:
+                    record[self._get_color_name(pixels[previous])] += 1
+                else:
+                    record[self._get_color_name(0)] += 1
         
             
-        indexes = []
-        indexes.extend(branch.get_indexes(crossroad))
-        if branch.get_crossroad(crossroad):
-            indexes.append(branch.get_crossroad(crossroad).get_index())
-
-        for n in indexes:
-            if previous:
-                if self._is_direct_neighbour(n, previous):
-                    direct += 1
-                else:
-                    diagonal += 1
-                if pixels[n] != pixels[previous] and n != indexes[0]: # ignore color change immediately after crossroad
-                    # color changed
-                    record["barva"] = self._get_color_name(pixels[previous])
-                    record["delka"] = self._get_skeleton_length(direct, diagonal, dpi)
-                    record[self._get_color_name(pixels[n])] += 1 
-                    data.append(record)
-                    record = defaultdict(int)
-                    record[self._get_color_name(pixels[previous])] += 1 
-                    direct = 0
-                    diagonal = 0
-            previous = n
-        else:
+            indexes = skeleton.pixels(edge, node)
+            nextNode = skeleton.opposite(edge, node)
+            if nextNode != graph.NONE:
+                indexes.append(skeleton.node_pixel(nextNode))
+
+            # codes of steps to the pixels, there is no step to the first
+            # pixel at the begining of the root
+            codes = skeleton.chain(edge, node)
+            shift = len(indexes) - len(codes)
+            colors = [pixels[n] for n in indexes]
+            begin = 0
+            # color change immediately after crossroad is ignored
+            for k in (numpy.flatnonzero(numpy.diff(colors)) + 1).tolist():
+                # color changed
+                end = k - shift + 1
+                d, o, c, last = estimators.count_steps(codes[begin:end], last)
+                record["barva"] = self._get_color_name(colors[k - 1])
+                record["delka"] = self._get_skeleton_length(direct + d, diagonal + o, dpi, corners + c)
+                record[self._get_color_name(colors[k])] += 1 
+                data.append(record)
+                record = defaultdict(int)
+                record[self._get_color_name(colors[k - 1])] += 1 
+                direct = 0
+                diagonal = 0
+                corners = 0
+                begin = end
+            d, o, c, last = estimators.count_steps(codes[begin:], last)
+            direct += d
+            diagonal += o
+            corners += c
+            n = previous = indexes[-1]
+
             # branch over
-            c = branch.get_crossroad(crossroad)
-            if c: 
+            if nextNode != graph.NONE: 
                 # continue with the branch that has same color as the crossroad
                 # there should be exactly one
                 same = [] # branches that have the same color as the crossroad
                 different = [] # branches that have different color than the crossroad
-                for b in c.get_branches(branch):
-                    col = pixels[b.get_first_index(c)]
+                for e in skeleton.node_edges(nextNode, edge):
+                    col = pixels[skeleton.first_pixel(e, nextNode)]
                     if col == pixels[n]:
-                        same.append((b, col))
+                        same.append((e, col))
                     else:
-                        different.append((b, col))
-                
+                        different.append((e, col))
+            
                 if len(same) + len(different) > 2:
                     # only three way crossroads are allowed
                     raise AnalyzerError("Four way crossroad at %s." % (self._coords.index_to_coord(n)))
@@ -277,85 +354,242 @@ class Analyzer:
                     raise AnalyzerError("Too many branches with different color than '%s' at %s." % (self._get_color_name(pixels[n]), self._coords.index_to_coord(n)))
                 else:
                     record[self._get_color_name(different[0][1])] += 1 
-                    data.extend(self._measure_colors(same[0][0], c, pixels, dpi, record, direct, diagonal))
-                    data.extend(self._measure_colors(different[0][0], c, pixels, dpi, None, 0, 0))
+                    # measure the branch with the same color first
+                    stack.append((different[0][0], nextNode, None, 0, 0, 0, None))
+                    stack.append((same[0][0], nextNode, record, direct, diagonal, corners, last))
             else:
                 # end of branch without crossroad
                 record["barva"] = self._get_color_name(pixels[previous])
-                record["delka"] = self._get_skeleton_length(direct, diagonal, dpi)
-                record[self._get_color_name(None)] += 1 
+                record["delka"] = self._get_skeleton_length(direct, diagonal, dpi, corners)
+                record[self._get_color_name(0)] += 1 
                 data.append(record)
                 record = defaultdict(int)
                 direct = 0
                 diagonal = 0
-        return data                    
+        return data
     
+    def analyze(self, img, dpi, group_threshold = 20, debug = None):
+        """Measure colored root in image 'img'.
+
+        Background is removed, the root is thinned into a skeleton and
+        the skeleton is measured without saving any intermediate image.
+        If 'debug' is given, black and white root and its skeleton are
+        saved into files 'debug'.root.png and 'debug'.skel.png.
+
+        Returns the same as measure_skeleton()."""
+        pixels, groups, indexes = self.filter_background2(img, group_threshold)
+        if debug:
+            self.save_pixels(debug + ".root.png", pixels)
+        skeleton = self.skeletonize(pixels)
+        if debug:
+            self.save_pixels(debug + ".skel.png", skeleton)
+        return self.measure_skeleton_pixels(img, skeleton, dpi)
+
     def measure_skeleton(self, img, skel, dpi):
-        img = img.getdata()
-        skel = skel.getdata()
+        """Measure skeleton in black and white image 'skel'.
+
+        See measure_skeleton_pixels()."""
+        pixels = numpy.asarray(skel.convert("L")) >= 128
+        return self.measure_skeleton_pixels(img, pixels, dpi)
+
+    def measure_skeleton_pixels(self, img, pixels, dpi):
+        """Measure lengths of colored sections of skeleton 'pixels'.
+
+        Skeleton pixels are non zero, other pixels are 0. Colors of the
+        skeleton are taken from image 'img'. Returns tuple (pixels, data)
+        where 'pixels' is an array of (r, g, b) colors of the skeleton pixels
+        (other pixels are white) and 'data' is a list of measured sections.
+
+        Only indexes of skeleton pixels are kept, so the measurement depends
+        on the length of the skeleton and not on the size of the image.
+        Colors are represented by their numbers in the palette during the
+        measurement, see Palette."""
+        indexes = numpy.flatnonzero(numpy.asarray(pixels).ravel())
         self._print("Determining colors in skeleton.")
-        white = (255, 255, 255)
-        colors = [record[1] for record in self._colors]
-        pixels = [0 if c < 128 else 1 
-                    for c in skel]
-        groups, indexes = self._groups_init(pixels, self._neigh8)
-        fg_indexes = filter(lambda i: pixels[i[0]] == 1, indexes)
-        if len(fg_indexes) == 0:
+        with self._recorder.stage("colors"):
+            numbers = self._colors.classify(img, indexes)
+        with self._recorder.stage("trace"):
+            skeleton = self._trace_skeleton(indexes, numbers)
+        with self._recorder.stage("measure"):
+            try:
+                return self._measure_graph(img, skeleton, dpi, indexes, numbers)
+            except AnalyzerError as e:
+                # crossings of thinned skeletons may be too complex for
+                # crossroads found by counting neighbours
+                self._print("Tracing crossings again: %s" % (str(e)))
+        self._recorder.count("retraced", 1)
+        with self._recorder.stage("trace"):
+            skeleton = self._trace_skeleton(indexes, numbers, True)
+        with self._recorder.stage("measure"):
+            return self._measure_graph(img, skeleton, dpi, indexes, numbers, True)
+
+    def trace_skeleton(self, img, pixels, crossings = False):
+        """Trace skeleton 'pixels' colored by image 'img' into a graph.
+
+        Skeleton pixels are non zero, other pixels are 0. The graph starts
+        at the begining of the root. If 'crossings' is True, neighbouring
+        junction pixels are traced as one crossroad. Returns SkeletonGraph,
+        see graph.py."""
+        indexes = numpy.flatnonzero(numpy.asarray(pixels).ravel())
+        with self._recorder.stage("colors"):
+            numbers = self._colors.classify(img, indexes)
+        with self._recorder.stage("trace"):
+            return self._trace_skeleton(indexes, numbers, crossings)
+
+    def measure_graph(self, img, skeleton, dpi, crossings = False):
+        """Measure lengths of colored sections of traced 'skeleton'.
+
+        Colors of the skeleton are taken from image 'img', 'crossings' must
+        be the same as when the skeleton was traced. Returns the same as
+        measure_skeleton_pixels()."""
+        indexes = numpy.sort(skeleton.indexes())
+        with self._recorder.stage("colors"):
+            numbers = self._colors.classify(img, indexes)
+        with self._recorder.stage("measure"):
+            return self._measure_graph(img, skeleton, dpi, indexes, numbers,
+                    crossings)
+
+    def _trace_skeleton(self, indexes, numbers, crossings = False):
+        """Trace skeleton whose pixels have sorted flat 'indexes' and colors
+        'numbers'.
+
+        A branch ends with a crossroad at the pixel where it has more than
+        one unvisited neighbour. If 'crossings' is True, a branch that
+        reaches a junction pixel ends at the crossing of neighbouring
+        junction pixels instead, the crossing is a single crossroad."""
+        width = self._coords.width()
+        labels, count = labeling.label_points(indexes, width, eight=True)
+        if count == 0:
             raise AnalyzerError("No skeleton found")
-        elif len(fg_indexes) > 1:
-            raise AnalyzerError("Too many skeletons (%d)." % (len(fg_indexes)))
-        skel = fg_indexes[0] # select first (and the only) skeleton
-        tails = self._find_tails(skel)
-        coloredpixels = [white if pixels[i] == 0 else img[i]
-                for i in self._coords.indexes()]
-        start = self._find_root_begining(tails, coloredpixels)
-
-        # find crossroads and branches
-        crossroads = []
-        branches = []
-        index = start
-        pixels[index] = 2
-        branch = Branch(None)
-        branch.append(index)
-        branches.append(branch)
-        queue = deque([branch])
+        elif count > 1:
+            raise AnalyzerError("Too many skeletons (%d)." % (count))
+        codes = topology.neighbourhood_points(indexes, width)
+        kinds = topology.kinds(codes)
+        tails = self._find_tails(kinds)
+        labels, count = topology.junctions_points(indexes, kinds, width)
+        self._print("Found %d tails and %d crossings." % (len(tails), count))
+        self._recorder.count("skeleton_pixels", len(indexes))
+        self._recorder.count("tails", len(tails))
+        self._recorder.count("crossings", count)
+        start = self._find_root_begining(indexes[tails], numbers[tails])
+
+        # neighbouring junction pixels form one crossing, crossing is a single
+        # crossroad whose pixel is the first of its pixels
+        junctions = indexes[kinds == topology.JUNCTION]
+        clusters = [junctions[m].tolist() for m in labeling.members(labels, count)]
+        crossing = dict(itertools.izip(junctions.tolist(), (labels - 1).tolist()))
+
+        # find crossroads and branches, neighbours of each pixel are given
+        # by its neighbourhood code
+        codes = dict(itertools.izip(indexes.tolist(), codes.tolist()))
+        offsets = self._neigh8.offsets()
+        visited = set([start])
+        nodes = [] # (index, branches) of each crossroad
+        edges = [] # [start crossroad, end crossroad, indexes] of each branch
+        edges.append([graph.NONE, graph.NONE, [start]])
+        queue = deque([0])
         while len(queue) > 0:
             # get next index
-            branch = queue.popleft()
-            index = branch.get_last_index()
-            if not coloredpixels[index] in colors:
-                raise AnalyzerError("Unknown color %s at %s" % (coloredpixels[index], self._coords.index_to_coord(index)))
-            if pixels[index] == 2: # already selected
-                neighbours = self._filter_neighbours8_by_color(index, 1, pixels)
-                l = len(neighbours)
-                if l == 0:
-                    pass
-                elif l == 1:
-                    n = neighbours[0]
-                    pixels[n] = 2
-                    branch.append(n)
-                    queue.append(branch)
-                else:
-                    crossroad = Crossroad(index, branch)
-                    for n in neighbours:
-                        pixels[n] = 2
-                        branch = Branch(crossroad)
-                        branch.append(n)
-                        branches.append(branch)
-                        crossroad.append(branch)
-                        queue.append(branch)
-                    crossroads.append(crossroad)
+            edge = queue.popleft()
+            index = edges[edge][2][-1]
+            neighbours = [index + o for o in offsets[codes[index]]
+                            if index + o not in visited]
+            entered = [n for n in neighbours if n in crossing] if crossings else []
+            l = len(neighbours)
+            if entered:
+                # the branch enters a crossing, branches leave the crossing
+                # from all its pixels
+                pixels = clusters[crossing[entered[0]]]
+                paths = self._crossing_paths(pixels, crossing, codes, offsets)
+                visited.update(pixels)
+                node = len(nodes)
+                edges[edge][1] = node
+                edges[edge][2].extend(reversed(paths[entered[0]]))
+                branches = [edge]
+                for p in pixels:
+                    for o in offsets[codes[p]]:
+                        n = p + o
+                        if n not in visited:
+                            visited.add(n)
+                            branches.append(len(edges))
+                            queue.append(len(edges))
+                            edges.append([node, graph.NONE, paths[p] + [n]])
+                nodes.append((pixels[0], branches))
+            elif l == 0:
+                pass
+            elif l == 1:
+                n = neighbours[0]
+                visited.add(n)
+                edges[edge][2].append(n)
+                queue.append(edge)
+            else:
+                # the last pixel of the branch is a crossroad
+                node = len(nodes)
+                edges[edge][1] = node
+                edges[edge][2].pop()
+                branches = [edge]
+                for n in neighbours:
+                    visited.add(n)
+                    branches.append(len(edges))
+                    queue.append(len(edges))
+                    edges.append([node, graph.NONE, [n]])
+                nodes.append((index, branches))
+        self._recorder.count("crossroads", len(nodes))
+        self._recorder.count("branches", len(edges))
+        return graph.SkeletonGraph.from_lists(self._coords.size(), nodes, edges)
+
+    def _crossing_paths(self, pixels, crossing, codes, offsets):
+        """Return paths from the crossroad to junction 'pixels' of one
+        crossing.
+
+        The crossroad is the first pixel of the crossing, 'crossing' maps
+        junction pixels to their crossings. Returns dictionary that maps
+        each pixel to the list of pixels that lead to it from the crossroad,
+        the list ends with the pixel and it does not include the crossroad.
+        Branches that leave the crossing continue these paths, so all steps
+        of the branches are steps between neighbouring pixels."""
+        paths = {pixels[0]: []}
+        queue = deque(pixels[:1])
+        while queue:
+            index = queue.popleft()
+            for o in offsets[codes[index]]:
+                n = index + o
+                if n not in paths and crossing.get(n) == crossing[index]:
+                    paths[n] = paths[index] + [n]
+                    queue.append(n)
+        return paths
+
+    def _measure_graph(self, img, skeleton, dpi, indexes, numbers, crossings = False):
+        """Measure 'skeleton' whose pixels have sorted flat 'indexes' and
+        colors 'numbers'. 'crossings' tells whether crossings were traced
+        as single crossroads."""
+        unknown = indexes[numbers == 0]
+        if len(unknown):
+            coord = self._coords.index_to_coord(int(unknown[0]))
+            raise AnalyzerError("Unknown color %s at %s" % (img.getpixel(coord), coord))
+        # number of color of each pixel of the skeleton
+        pixels = dict(itertools.izip(indexes.tolist(), numbers.tolist()))
+
+        if crossings:
+            # crossroad of a crossing with the color of only one of its
+            # branches is painted by the branch that goes through it
+            for c in xrange(skeleton.nodes_count()):
+                node = skeleton.node_pixel(c)
+                first = [pixels[skeleton.first_pixel(e, c)] for e in skeleton.node_edges(c)]
+                if first.count(pixels[node]) < 2:
+                    for color in first:
+                        if first.count(color) >= 2:
+                            pixels[node] = color
+                            break
 
         # on each crossroad, determine which color starts here and which continues
-        pixels = coloredpixels
-    
-        for c in crossroads:
-            n = c.get_index()
-            nc = pixels[n]
+        memo = {} # results of _follow_root_by_color()
+        for c in xrange(skeleton.nodes_count()):
+            nc = pixels[skeleton.node_pixel(c)]
             colordata = []
-            for b in c.get_branches():
-                length, next_color = self._follow_root_by_color(b, c, nc, pixels)
-                colordata.append((b, nc, length, next_color))
+            for e in skeleton.node_edges(c):
+                length, next_color = self._follow_root_by_color(skeleton, e, c, nc, pixels, memo)
+                colordata.append((e, nc, length, next_color))
             if len(colordata) == 3:
                 colors = map(lambda b: b[1], colordata)
                 if colors[0] == colors[1] == colors[2]:
@@ -364,72 +598,101 @@ class Analyzer:
                     index, value = min(enumerate(lengths), key=operator.itemgetter(1))
                     if value:
                         # recolor only branches with at least one pixel
-                        self._recolor_branch(colordata[index][0], c, nc, colordata[index][3], pixels)
+                        self._recolor_branch(skeleton, colordata[index][0], c, nc, colordata[index][3], pixels)
+                        # followed sections may have changed
+                        memo.clear()
             else:
-                raise AnalyzerError("There are %d branches leading from a crossroad at %s." % (len(neighbours), str(self._coords.index_to_coord(index))))
+                raise AnalyzerError("There are %d branches leading from a crossroad at %s." % (len(colordata), str(self._coords.index_to_coord(skeleton.node_pixel(c)))))
 
         # this is a begining of the root, mark the tail
-        data = self._measure_colors(branches[0], None, pixels, dpi, None, 0, 0)
+        data = self._measure_colors(skeleton, pixels, dpi)
         data.reverse()
-        return pixels, data
-
-    def _find_root_begining(self, tails, pixels):
-        for n, c in self._colors:
-            if n == "modra":
-                blue = c
-            if n == "cervena":
-                red = c
-        
-        # find the heighest blue tail
-        best = len(pixels)
-        for t in tails:
-            if pixels[t] == blue and t < best:
-                best = t
-        # if no blue tail exists, find highest red tail
-        if best == len(pixels):
-            for t in tails:
-                if pixels[t] == blue and t < best:
-                    best = t
-        # if neither blue nor red tail exists, find the highest tail
-        if best == len(pixels):
-            for t in tails:
-                if t < best:
-                    best = t
-        if best == len(pixels):
+        self._recorder.count("sections", len(data))
+        colors = numpy.empty((self._coords.total(), 3), dtype=numpy.uint8)
+        colors.fill(255)
+        colors[indexes] = self._colors.to_rgb(numpy.fromiter(
+                (pixels[i] for i in indexes.tolist()), dtype=numpy.uint8,
+                count=len(indexes)))
+        return colors, data
+
+    def _find_root_begining(self, tails, colors):
+        """Return the heighest blue tail. If no blue tail exists return the
+        heighest red tail or the heighest tail.
+
+        'tails' is a sorted array of indexes of tails, colors[i] is number
+        of color of tails[i]."""
+        blue = self._colors.find("modra", "blue")
+        red = self._colors.find("cervena", "red")
+        for color in (blue, red):
+            if color:
+                found = tails[colors == color]
+                if len(found):
+                    return int(found[0])
+        if not len(tails):
             raise AnalyzerError("No root begining found.")
-        return best
-
-    def _follow_root_by_color(self, branch, crossroad, color, pixels):
-        # follow pixels of the root on given branch starting from given crossroad
-        length = 0
-        for n in branch.get_indexes(crossroad):
-            if pixels[n] == color:
-                # branch continues with the same color
-                length += 1
-            else:
-                # branch continues but with a different color
-                return (length, pixels[n])
-        else:
-            # end of a section, continue recursively from next crossroad
-            nextCrossroad = branch.get_crossroad(crossroad)
-            if nextCrossroad:
-                n = nextCrossroad.get_index()
-                if pixels[n] != color:
-                    # crossroad has different color
-                    return (length, pixels[n])
-                longest = (-1, None)
-                for b in nextCrossroad.get_branches(branch):
-                    (l, c) = self._follow_root_by_color(b, nextCrossroad, color, pixels)
-                    if longest[0] < l:
-                        longest = (l, c)
-                # return length of the longest section
-                return (length + longest[0], longest[1])
-            else:
-                # end of the root
-                return (length, None)
-
-    def _recolor_branch(self, branch, crossroad, color, newColor, pixels):
-        for n in branch.get_indexes(crossroad):
+        return int(tails[0])
+
+    def _follow_root_by_color(self, skeleton, edge, node, color, pixels, memo):
+        """Follow pixels of the root on branch 'edge' starting from crossroad
+        'node' while they have color 'color'.
+
+        On each crossroad the longest of the following branches is taken.
+        Returns tuple (length, color) of length of the section and the color
+        that follows it. Results for all visited branches are stored in
+        dictionary 'memo' under (branch, crossroad, color) keys and they are
+        reused, so every branch is followed only once."""
+        # [branch, crossroad, length, next crossroad], length is None until
+        # pixels of the branch are followed
+        stack = [[edge, node, None, None]]
+        while stack:
+            frame = stack[-1]
+            e, c = frame[0], frame[1]
+            if (e, c, color) in memo:
+                stack.pop()
+                continue
+            if frame[2] is None:
+                length = 0
+                result = None
+                for n in skeleton.pixels(e, c):
+                    if pixels[n] == color:
+                        # branch continues with the same color
+                        length += 1
+                    else:
+                        # branch continues but with a different color
+                        result = (length, pixels[n])
+                        break
+                else:
+                    # end of a section, continue from next crossroad
+                    nextNode = skeleton.opposite(e, c)
+                    if nextNode == graph.NONE:
+                        # end of the root
+                        result = (length, 0)
+                    elif pixels[skeleton.node_pixel(nextNode)] != color:
+                        # crossroad has different color
+                        result = (length, pixels[skeleton.node_pixel(nextNode)])
+                    frame[3] = nextNode
+                if result:
+                    memo[(e, c, color)] = result
+                    stack.pop()
+                    continue
+                frame[2] = length
+                # follow branches behind the crossroad first
+                for b in reversed(skeleton.node_edges(frame[3], e)):
+                    if (b, frame[3], color) not in memo:
+                        stack.append([b, frame[3], None, None])
+                continue
+            longest = (-1, 0)
+            for b in skeleton.node_edges(frame[3], e):
+                (l, next_color) = memo[(b, frame[3], color)]
+                if longest[0] < l:
+                    longest = (l, next_color)
+            # return length of the longest section
+            memo[(e, c, color)] = (frame[2] + longest[0], longest[1])
+            stack.pop()
+        return memo[(edge, node, color)]
+
+    def _recolor_branch(self, skeleton, edge, node, color, newColor, pixels):
+        for n in skeleton.pixels(edge, node):
             if not newColor:
                 raise AnalyzerError("Recoloring with an invalid color at %s." % (str(self._coords.index_to_coord(n))))
             if pixels[n] == color:
@@ -439,152 +702,164 @@ class Analyzer:
                 # branch continues but with a different color
                 break
    
-    def _get_skeleton_length(self, direct, diagonal, dpi):
-        length = (math.sqrt(2)*diagonal + direct)*25.4/dpi # 1 inch = 25.4 mm
+    def _get_skeleton_length(self, direct, diagonal, dpi, corners = 0):
+        length = estimators.length(direct, diagonal, corners, self._estimator)*25.4/dpi # 1 inch = 25.4 mm
         return length
        
-    def _is_direct_neighbour(self, index, neighbour):
-        direct_neighbours = self._neigh4.neighs_as_indexes(index)
-        return neighbour in direct_neighbours
-
-    def _get_color_name(self, color):
-        for c in enumerate(self._colors):
-            if c[1][1] == color:
-                return c[1][0]
-        return "bila"
-        #raise AnalyzerError("Unknown color (%d, %d, %d)" % (color))
+    def _get_color_name(self, number):
+        return self._names[number]
 
     def _get_branch_name(self, color1, color2):
         name1 = self._get_color_name(color1)
         name2 = self._get_color_name(color2)
         return "%s_%s" % (name1, name2)
 
-    def _filter_neighbours8(self, index, value, pixels):
-        """Filter neighbours of pixel with index 'index' that have value
-        'value'. Returns list of indexes of neighbouring pixels."""
-        return self._filter_neighbours8_by_condition(index,
-            lambda n: pixels[n] == value)
-    
-    def _filter_neighbours8_by_color(self, index, color, pixels, previous = None):
-        return self._filter_neighbours8_by_condition(index, 
-                    lambda n: pixels[n] == color and n != previous)
-
-    
-    def _filter_neighbours8_by_condition(self, index, condition):
-        all_neighbours = self._neigh8.neighs_as_indexes(index)
-        neighbours = filter(condition, all_neighbours)
-        return neighbours
-
-    def _find_tails(self, indexes):
-        """Find tails of given skeleton. Indexes are indexes of pixels of 
-        this skeleton. Tail is a pixel that has only one neighbour.
-        Returns list of tails."""
-        pixels = [0] * self._coords.total()
-        for i in indexes:
-            pixels[i] = 1
-        tails = []
-        queue = deque([indexes[0]]) # select first pixel of the skeleton
-        while len(queue) > 0:
-            # get next index
-            index = queue.popleft()
-            if pixels[index] == 1:
-                pixels[index] = 2 # 0 == bg, 1 == fg, 2 == visited fg
-                # get neighbours of selected index
-                all_neighbours = self._neigh8.neighs_as_indexes(index)
-                # filter out those neighbours that have already been visited
-                # or that are background
-                neighbours = filter(lambda n: pixels[n] == 1, all_neighbours)
-                if (len(neighbours) == 0 or
-                   (len(neighbours) == 1 and index == indexes[0])):
-                   # if there are no neighbours that havent been visited
-                   # yet or if the first pixel has exactly one neighbour
-                   # then the end of the tail was encountered
-                   tails.append(index)
-                queue.extend(neighbours)
-        return tails
-                
+    def _find_tails(self, kinds):
+        """Find tails of a skeleton. 'kinds' are kinds of pixels of the
+        skeleton, see topology.kinds(). Tail is a pixel whose neighbours
+        all lie on one side of it. Returns sorted array of positions of
+        tails in 'kinds'."""
+        return numpy.flatnonzero(kinds.ravel() == topology.END)
 
     def _groups_init(self, pixels, neigh):
-        """Assign all pixels into group based on same bg/fg status."""
+        """Assign all pixels into group based on same bg/fg status.
+
+        Returns tuple (groups, indexes). 'groups' holds group number of each
+        pixel, groups are numbered from 1 in order of their first pixel.
+        'indexes' holds array of pixel indexes for each group."""
         self._print("Splitting pixels into groups.")
-        # each pixel will be assigned to one group
-        groups = [0] * self._coords.total()
-        # list of lists of pixels for each group
-        indexes = []
-        value = 1
-        for i in self._coords.indexes():
-            if groups[i] == 0:
-                # found pixel that does not belong to any group yet, 
-                # perform flood fill
-                indexes.append(self._flood(neigh, groups, pixels, i, value))
-                value = value + 1
+        mask = numpy.asarray(pixels, dtype=numpy.uint8).reshape(
+                self._coords.height(), self._coords.width())
+        with self._recorder.stage("groups"):
+            labels, count = labeling.label(mask, neigh.eight())
+            groups = labels.ravel()
+            indexes = labeling.members(groups, count)
+        self._recorder.count("groups", count)
         self._print("Found %d groups." % len(indexes))
         return groups, indexes
     
-    def _groups_prune(self, pixels, groups, indexes, neighs, group_threshold):
+    def _groups_prune(self, pixels, neigh, group_threshold):
         """Assume that small groups are mistakes. Switch pixels of groups
-        whose size is smaler than threshold."""
+        whose size is smaler than threshold until no such group remains.
+
+        Pixels are changed in place. Returns tuple (groups, indexes) of the
+        final pixels, see _groups_init()."""
         self._print("Prunning groups.")
-        pruned = 0
-        for group in indexes:
-            if len(group) <= group_threshold:
-                for i in group:
-                    # change bg/fg pixel
-                    pixels[i] = 0 if pixels[i] == 1 else 1
-                pruned += 1
+        # uint8 array of pixels is pruned directly without a copy
+        mask = numpy.asarray(pixels, dtype=numpy.uint8).reshape(
+                self._coords.height(), self._coords.width())
+        copied = not numpy.may_share_memory(mask, pixels)
+        with self._recorder.stage("prune"):
+            labels, count, pruned, rounds = labeling.prune(mask,
+                    group_threshold, neigh.eight())
+            if copied and isinstance(pixels, numpy.ndarray):
+                pixels[:] = mask.ravel()
+            elif copied:
+                for i in numpy.flatnonzero(mask.ravel() != numpy.asarray(pixels)):
+                    pixels[i] = 1 - pixels[i]
+            groups = labels.ravel()
+            indexes = labeling.members(groups, count)
         self._print("Pruned %d groups." % (pruned))
-        return self._groups_init(pixels, neighs)
-        
-    def _flood(self, neighs, groups, pixels, index, value):
-        orig = pixels[index] # background or foreground
-        indexes = []
-        queue = deque([index])
-        while len(queue) > 0:
-            # get next index
-            index = queue.popleft()
-            if groups[index] != value:
-                # add selected neighbour to current group
-                groups[index] = value
-                indexes.append(index)
-                # get neighbours of selected index
-                all_neighbours = neighs.neighs_as_indexes(index)
-                # filter out those neighbours that have already been selected
-                # or that are marked as background
-                neighbours = [n for n in all_neighbours 
-                                if groups[n] != value and pixels[n] == orig]
-                # add remaining neighbours to the queue
-                queue.extend(neighbours) #mumumu
-        self._print("Filled %d pixels." % (len(indexes)))
-        return indexes
-
-    def save_pixels(self, filename, pixels, version = "BW"):
-        if not pixels:
+        self._recorder.count("pixels", mask.size)
+        self._recorder.count("foreground", numpy.count_nonzero(mask))
+        self._recorder.count("pruned", pruned)
+        self._recorder.count("prune_rounds", rounds)
+        self._recorder.count("groups", count)
+        self._print("Found %d groups." % len(indexes))
+        return groups, indexes
+
+    def save_pixels(self, filename, pixels, version = "BW", strip = 256):
+        """Save pixels into image file 'filename'.
+
+        Version "BW" saves black and white image where zero pixels are
+        black and other pixels white, "GS" saves grayscale image where
+        values of pixels are scaled to range 0..255 and "RGB" saves color
+        image from pixels that are (r, g, b) tuples. Large png images are
+        compressed and written in strips of 'strip' rows."""
+        if pixels is None or len(pixels) == 0:
             return
+        with self._recorder.stage("save"):
+            mode, data = self._pixels_to_array(pixels, version)
+            size = self._coords.size()
+            if filename.lower().endswith(".png") and data.size > STREAM_PIXELS:
+                with PngWriter(filename, size, mode) as png:
+                    for top in xrange(0, size[1], strip):
+                        png.write(data[top:top + strip].tobytes())
+            else:
+                Image.frombytes(mode, size, data.tobytes()).save(filename)
+
+    def save_pixel_strips(self, filename, strips):
+        """Save black and white image from strips of pixels, see
+        filter_background_strips(). Png images are written strip by strip,
+        so the time of the stage includes the final pass of the pruning."""
+        size = self._coords.size()
+        if filename.lower().endswith(".png"):
+            with self._recorder.stage("save"), PngWriter(filename, size, "L") as png:
+                for rows in strips:
+                    data = (rows != 0).astype(numpy.uint8)
+                    data *= 255
+                    png.write(data.tobytes())
+        else:
+            self.save_pixels(filename, numpy.vstack(list(strips)).ravel())
+
+    def _pixels_to_array(self, pixels, version):
+        """Convert pixels into uint8 array with one row of the image in
+        each row of the array. Returns tuple (mode, array)."""
+        shape = (self._coords.height(), self._coords.width())
         if version == "BW": # black and white picture
-            img = Image.new("L", self._coords.size())
-            for i in self._coords.indexes():
-                col = 0 if pixels[i] == 0 else 255
-                xy = self._coords.index_to_coord(i)
-                img.putpixel(xy, col)
+            values = _to_array(pixels)
+            data = (values != 0).astype(numpy.uint8)
+            data *= 255
+            return "L", data.reshape(shape)
         elif version == "GS": # grayscale picture
-            img = Image.new("L", self._coords.size())
-            minimum = min(pixels)
-            maximum = max(pixels)
-            distance = maximum - minimum
-            for i in self._coords.indexes():
-                col = int(255*pixels[i]/distance)
-                xy = self._coords.index_to_coord(i)
-                img.putpixel(xy, col)
+            values = numpy.asarray(pixels, dtype=numpy.float64)
+            minimum = values.min()
+            distance = values.max() - minimum
+            if distance == 0:
+                # all pixels have the same value
+                distance = 1
+            data = ((values - minimum) * (255 / distance)).astype(numpy.uint8)
+            return "L", data.reshape(shape)
         elif version == "RGB": # RGB picture
-            img = Image.new("RGB", self._coords.size())
-            img.putdata(pixels)
-        img.save(filename)
+            if isinstance(pixels, numpy.ndarray):
+                data = pixels.astype(numpy.uint8, copy=False)
+            else:
+                data = numpy.frombuffer(
+                        bytearray(itertools.chain.from_iterable(pixels)),
+                        dtype=numpy.uint8)
+            return "RGB", data.reshape(shape + (3,))
+        raise AnalyzerError("Unknown image version '%s'." % (version))
     
     def _print(self, text):
         if self._verbose: print text
 
+def _image_array(img, mode):
+    """Return flat uint8 array with bytes of image 'img' in given mode.
+
+    The array is a read only view of the bytes of the image."""
+    if img.mode != mode:
+        img = img.convert(mode)
+    return numpy.frombuffer(img.tobytes(), dtype=numpy.uint8)
+
+def _to_array(pixels):
+    """Return pixels as a flat numpy array without copying it if possible."""
+    if isinstance(pixels, numpy.ndarray):
+        return pixels.ravel()
+    try:
+        # bytes are the most compact and fastest to convert to
+        return numpy.frombuffer(bytearray(pixels), dtype=numpy.uint8)
+    except ValueError:
+        # some value does not fit into a byte
+        return numpy.asarray(pixels)
+
 def load_colors():
+    """Load palette from file colors.cfg.
+
+    Each line contains name of the color, its code and optionally the
+    tolerance, the largest difference of a channel of a pixel from the
+    color for which the pixel still has the color."""
     colors = []
+    tolerances = []
     with open("colors.cfg") as f:
         f.readline() # first line contains headers
         for line in f.readlines():
@@ -593,5 +868,7 @@ def load_colors():
                 continue
             (name, color, others) = line.split(";", 2)
             color = ImageColor.getrgb("#"+color[2:]) # color must be in form '#rrggbb'
+            tolerance = others.split(";", 1)[0].strip()
             colors.append((name, color))
-    return colors
+            tolerances.append(int(tolerance) if tolerance else 0)
+    return Palette(colors, tolerances)
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+"""Benchmarks of the analyzer on synthetic images, see synthetic.py.
+
+Every benchmark times one method of Analyzer on images of several sizes.
+The best time of several runs is reported together with the exponent of a
+curve time = c * pixels ** exponent fitted through the times, exponent
+close to 1 means that the time grows linearly with the number of pixels.
+Results can be saved as a baseline and later runs compared against it."""
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy
+from analyzer import Analyzer, load_colors
+import synthetic
+import topology
+
+BENCHMARKS = ("_groups_init", "filter_background2", "_find_tails",
+        "measure_skeleton", "save_pixels")
+
+DPI = 300
+GROUP_THRESHOLD = 20
+
+# shortest time of one run of a benchmark in seconds
+MINIMUM = 0.05
+
+def prepare(size, colors, directory, depth = 3, specks = 0, seed = 0):
+    """Generate synthetic image of given size and prepare inputs of all
+    benchmarks. Files are written into 'directory'.
+
+    Returns dictionary that maps names of benchmarks to functions without
+    arguments."""
+    img, skel = synthetic.generate(size, depth, specks=specks, seed=seed)
+    analyzer = Analyzer(img, colors)
+    pixels, groups, indexes = analyzer.filter_background2(img, GROUP_THRESHOLD)
+    skeleton = numpy.flatnonzero(numpy.asarray(skel).ravel())
+    kinds = topology.kinds(topology.neighbourhood_points(skeleton, size[0]))
+    colored, data = analyzer.measure_skeleton(img, skel, DPI)
+    target = os.path.join(directory, "benchmark.png")
+    return {
+        "_groups_init": lambda: analyzer._groups_init(pixels, analyzer._neigh4),
+        "filter_background2": lambda: analyzer.filter_background2(img, GROUP_THRESHOLD),
+        "_find_tails": lambda: analyzer._find_tails(kinds),
+        "measure_skeleton": lambda: analyzer.measure_skeleton(img, skel, DPI),
+        "save_pixels": lambda: analyzer.save_pixels(target, colored, "RGB"),
+        }
+
+def run(sizes, names = BENCHMARKS, repeat = 3, depth = 3, density = 0, seed = 0):
+    """Run benchmarks 'names' on images of given (width, height) sizes.
+
+    'density' is the number of noise specks per million pixels. Returns
+    dictionary that maps names of benchmarks to dictionaries that map
+    sizes in the form WIDTHxHEIGHT to the best time in seconds."""
+    colors = load_colors()
+    colors.table() # the lookup table is created only once
+    results = dict((name, {}) for name in names)
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            key = "%dx%d" % size
+            print "Generating image %s." % (key)
+            specks = density * size[0] * size[1] // 1000000
+            benchmarks = prepare(size, colors, directory, depth, specks, seed)
+            for name in names:
+                results[name][key] = best_time(benchmarks[name], repeat)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def best_time(function, repeat):
+    """Return the best time of 'repeat' runs of 'function' in seconds.
+
+    Fast functions are called several times in each run so that the run
+    takes at least MINIMUM seconds."""
+    timer = timeit.Timer(function)
+    number = 1
+    time = timer.timeit(number)
+    if time < MINIMUM:
+        number = int(MINIMUM / max(time, 1e-6)) + 1
+    return min(timer.repeat(repeat, number)) / number
+
+def exponent(times):
+    """Return exponent of the curve fitted through 'times' of benchmarks
+    on images of different sizes or None if there are not enough times."""
+    points = [(math.log(_pixels(key)), math.log(time))
+                for key, time in times.iteritems() if time > 0]
+    if len(set(x for x, y in points)) < 2:
+        return None
+    x, y = zip(*points)
+    return numpy.polyfit(x, y, 1)[0]
+
+def report(results, baseline = None, tolerance = 0.1):
+    """Print times of benchmarks and their scaling.
+
+    If 'baseline' results are given, times are compared with them and
+    benchmarks that are slower by more than 'tolerance' are reported.
+    Returns number of such slower benchmarks."""
+    keys = sorted(set(key for times in results.itervalues() for key in times),
+            key=_pixels)
+    width = max(len(name) for name in results)
+    print "Best times in milliseconds:"
+    print "%-*s %s %9s" % (width, "benchmark",
+            " ".join("%11s" % key for key in keys), "exponent")
+    for name in sorted(results):
+        times = results[name]
+        scaling = exponent(times)
+        print "%-*s %s %9s" % (width, name,
+                " ".join("%11s" % ("%.4g" % (times[key] * 1000)
+                        if key in times else "-") for key in keys),
+                "%.2f" % scaling if scaling is not None else "-")
+    if baseline is None:
+        return 0
+
+    slower = []
+    print
+    print "Time relative to the baseline:"
+    for name in sorted(results):
+        ratios = []
+        for key in keys:
+            time = results[name].get(key)
+            base = baseline.get(name, {}).get(key)
+            if time is None or not base:
+                ratios.append("%11s" % "-")
+                continue
+            ratio = time / base
+            if ratio > 1 + tolerance:
+                slower.append((name, key, ratio))
+            ratios.append("%11s" % ("%.2f" % ratio))
+        print "%-*s %s" % (width, name, " ".join(ratios))
+    for name, key, ratio in slower:
+        print "Warning: %s is %.0f%% slower on %s." % (name, (ratio - 1) * 100, key)
+    return len(slower)
+
+def parse_size(text):
+    """Parse size given either as a side of a square or as WIDTHxHEIGHT."""
+    if "x" in text:
+        width, height = text.split("x", 1)
+        return int(width), int(height)
+    return int(text), int(text)
+
+def _pixels(key):
+    width, height = parse_size(key)
+    return width * height
+
+if __name__=="__main__":
+    # parse commandline arguments
+    parser = argparse.ArgumentParser(
+            description="Time parts of the analyzer on synthetic images of roots of several sizes.")
+    parser.add_argument("--sizes", type=str, default="256,512,1024,2048",
+            help="comma separated sizes of images, either a side of a square or WIDTHxHEIGHT")
+    parser.add_argument("--benchmarks", type=str, default=",".join(BENCHMARKS),
+            help="comma separated benchmarks to run, all by default")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="number of runs of each benchmark, the best time is reported")
+    parser.add_argument("--depth", type=int, default=3,
+            help="number of levels of side branches of the root")
+    parser.add_argument("--specks", type=int, default=2000,
+            help="number of noise specks per million pixels")
+    parser.add_argument("--seed", type=int, default=0,
+            help="seed of the generator of images")
+    parser.add_argument("--baseline", type=str,
+            help="json file with results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+            help="relative slowdown against the baseline that is reported")
+    parser.add_argument("--save", type=str,
+            help="json file where results will be saved as a new baseline")
+    arguments = parser.parse_args()
+    sizes = [parse_size(s) for s in arguments.sizes.split(",")]
+    names = arguments.benchmarks.split(",")
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '%s', choose from %s" % (name, ", ".join(BENCHMARKS)))
+
+    results = run(sizes, names, arguments.repeat, arguments.depth,
+            arguments.specks, arguments.seed)
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)["results"]
+    slower = report(results, baseline, arguments.tolerance)
+    if arguments.save:
+        with open(arguments.save, "w") as f:
+            json.dump({"depth": arguments.depth, "specks": arguments.specks,
+                    "seed": arguments.seed, "results": results}, f,
+                    indent=2, sort_keys=True)
+    if slower:
+        exit(1)
@@ -0,0 +1,110 @@
+"""Persistent record of inputs that produced output files.
+
+Each output directory has a manifest file. For every output file the
+manifest holds a key, a hash of content of all source files, parameters,
+palette and code used to compute the output, together with optional data
+(for example measured rows of the results). When the key of an output has
+not changed since the last run, the output does not have to be computed
+again."""
+import hashlib
+import json
+import os
+
+MANIFEST = ".manifest.json"
+
+def code_version(*modules):
+    """Return hash of source code of modules with given names."""
+    digest = hashlib.sha1()
+    for name in modules:
+        path = __import__(name).__file__
+        if path.endswith(".pyc") or path.endswith(".pyo"):
+            path = path[:-1]
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def parameters_digest(*parameters):
+    """Return hash of parameters, they must have stable repr()."""
+    return hashlib.sha1(repr(parameters)).hexdigest()
+
+def file_digest(path):
+    """Return hash of content of file 'path'."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class Manifest:
+    """Manifest of output files in one directory."""
+
+    def __init__(self, directory):
+        self._path = os.path.join(directory, MANIFEST)
+        self._files = {} # path -> (size, mtime, digest) of source files
+        self._outputs = {} # output filename -> {"key": key, "data": data}
+        if os.path.exists(self._path):
+            try:
+                with open(self._path) as f:
+                    manifest = json.load(f, object_hook=_to_str)
+                self._files = manifest["files"]
+                self._outputs = manifest["outputs"]
+            except (ValueError, KeyError):
+                print "Warning: Ignoring damaged manifest '%s'." % (self._path)
+
+    def digest(self, path):
+        """Return hash of content of source file 'path'.
+
+        File is not read again if its size and modification time did not
+        change since the hash was computed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record = self._files.get(path)
+        if record and record[0] == stat.st_size and record[1] == stat.st_mtime:
+            return record[2]
+        digest = file_digest(path)
+        self._files[path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def key(self, sources, *parameters):
+        """Return key of an output computed from files 'sources' with
+        given parameters. Parameters must have stable repr()."""
+        digest = hashlib.sha1()
+        for source in sources:
+            digest.update(self.digest(source))
+        digest.update(repr(parameters))
+        return digest.hexdigest()
+
+    def is_current(self, target, key):
+        """Return True if file 'target' exists and was computed with 'key'."""
+        record = self._outputs.get(os.path.basename(target))
+        return bool(record) and record["key"] == key and os.path.exists(target)
+
+    def data(self, target):
+        """Return data stored with file 'target'."""
+        return self._outputs[os.path.basename(target)]["data"]
+
+    def update(self, target, key, data = None):
+        """Record that file 'target' was computed with 'key'."""
+        self._outputs[os.path.basename(target)] = {"key": key, "data": data}
+
+    def save(self):
+        """Save the manifest, the previous version is replaced atomically."""
+        temporary = self._path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"files": self._files, "outputs": self._outputs}, f)
+        os.rename(temporary, self._path)
+
+def _to_str(record):
+    """Convert unicode keys and values loaded from json to str."""
+    converted = {}
+    for key, value in record.iteritems():
+        if isinstance(value, list):
+            value = [v.encode("utf-8") if isinstance(v, unicode) else v
+                        for v in value]
+        elif isinstance(value, unicode):
+            value = value.encode("utf-8")
+        converted[key.encode("utf-8")] = value
+    return converted
@@ -3,6 +3,8 @@
 import pygame
 import os
 import sys
+from collections import OrderedDict
+from prefetch import ImageCache
 
 class FileList:
     """Class representing a list of image files. """
@@ -72,6 +74,15 @@ class FileList:
         """Returns true if currently displayed file is the first one in the list."""
         return self.position <= 0
 
+    def nearbyImageFiles(self, count):
+        """Returns up to 'count' next and 'count' previous files, the closest first."""
+        files = []
+        for i in xrange(1, count + 1):
+            for position in (self.position + i, self.position - i):
+                if position >= 0 and position < len(self.imageFiles):
+                    files.append(self.imageFiles[position])
+        return files
+
 class Route:
     def __init__(self, point, color, width):
         self.color = color
@@ -85,6 +96,13 @@ class Route:
     def terminate(self):
         self.isTerminated = True
 
+    def boundary(self):
+        """Returns rectangle that contains all pixels drawn by the route."""
+        xs = [p[0] for p in self.points]
+        ys = [p[1] for p in self.points]
+        t = self.width
+        return pygame.Rect(min(xs) - t, min(ys) - t, max(xs) - min(xs) + 2 * t + 1, max(ys) - min(ys) + 2 * t + 1)
+
     def draw(self, image):
         for index in xrange(len(self.points) - 1):
             self.drawSection(image, index)
@@ -236,11 +254,64 @@ class Menu:
                 buttonRectangle = pygame.Rect(x, y, s, v)
                 button.draw(window, buttonRectangle)
 
+class TileCache:
+    """Zoomed parts of an image.
+
+    The image is split into square tiles, each tile is zoomed when it is
+    displayed for the first time. Tiles of the current zoom have about
+    TILE_SIZE pixels on the screen. At most 'capacity' tiles are kept, the
+    least recently used tiles are dropped first, so the memory depends on
+    the size of the window and not on the size of the zoomed image."""
+
+    """Size of a zoomed tile in pixels."""
+    TILE_SIZE = 256
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tiles = OrderedDict() # (zoom, column, row) -> zoomed tile, oldest first
+
+    def tileSize(self, zoom):
+        """Returns size of a tile in pixels of the original image."""
+        return max(1, TileCache.TILE_SIZE / zoom)
+
+    def get(self, image, zoom, column, row):
+        """Returns tile of 'image' at given column and row zoomed by 'zoom'."""
+        key = (zoom, column, row)
+        if key in self.tiles:
+            tile = self.tiles.pop(key)
+        else:
+            size = self.tileSize(zoom)
+            rectangle = pygame.Rect(column * size, row * size, size, size).clip(image.get_rect())
+            tile = pygame.transform.scale(image.subsurface(rectangle), [x * zoom for x in rectangle.size])
+            while len(self.tiles) >= self.capacity:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = tile # most recently used
+        return tile
+
+    def invalidate(self, rectangle):
+        """Drop tiles of all zooms that overlap 'rectangle' in the original image."""
+        for key in list(self.tiles):
+            zoom, column, row = key
+            size = self.tileSize(zoom)
+            if rectangle.colliderect(pygame.Rect(column * size, row * size, size, size)):
+                del self.tiles[key]
+
+    def clear(self):
+        self.tiles.clear()
+
 class Manager:
+    """Number of next and previous images loaded in the background."""
+    PREFETCH_IMAGES = 1
+
     def __init__(self, menu, window, filenames):
         self.window = window
         self.menu = menu
         self.filenames = filenames
+        # images are loaded in full resolution, so only a few are kept
+        self.images = ImageCache(pygame.image.load, 2 * Manager.PREFETCH_IMAGES + 1)
+        # twice the number of tiles that cover the window
+        width, height = window.get_size()
+        self.tiles = TileCache(2 * (width / TileCache.TILE_SIZE + 2) * (height / TileCache.TILE_SIZE + 2))
         self.color = menu.colorButtons[0].color
         self.thick()
         self.zoom = 1 
@@ -255,14 +326,15 @@ class Manager:
             print "No more files. Exiting."
             return False
         print "Loading file '%s'" % (filename)
-        self.image = loadImage(filename) # original image
+        self.image = self.images.get(filename).convert() # original image
         self.changedImage = self.image.copy() # image with changes
-        self.zoomedImage = self.image.copy() # image with changes and zoom
+        self.tiles.clear() # zoomed tiles of the changed image
         self.routes = [] # routes added to image
         self.removedRoutes = []
         # how many displayed pixels corespond to 1 pixel in original image
         self.shift = (0, 0)
         self.redraw()
+        self.images.prefetch(self.filenames.nearbyImageFiles(Manager.PREFETCH_IMAGES))
         return True
 
     def save(self):
@@ -270,6 +342,8 @@ class Manager:
         if self.routes:
             print "Saving file '%s'" % (filename)
             pygame.image.save(self.changedImage, self.filenames.currentImageFile())
+            # the loaded image is no longer the content of the file
+            self.images.discard(filename)
         else:
             print "No changes in file '%s'" % (filename)
 
@@ -283,16 +357,12 @@ class Manager:
         self.zoom = self.zoom + 1
         if self.zoom > 8:
             self.zoom = 8
-        size = [x * self.zoom for x in self.changedImage.get_size()]
-        self.zoomedImage = pygame.transform.scale(self.changedImage, size)
         self.redraw()
 
     def zoomOut(self):
         self.zoom = self.zoom - 1
         if self.zoom <= 1:
             self.zoom = 1
-        size = [x * self.zoom for x in self.changedImage.get_size()]
-        self.zoomedImage = pygame.transform.scale(self.changedImage, size)
         self.redraw()
 
     def setColor(self, color):
@@ -334,27 +404,22 @@ class Manager:
         route.add(point2)
         # draw line to the changed image
         route.drawLastSection(self.changedImage)
-        # cut selection rectangle from changed image in original scale
-        selection = self.changedImage.subsurface(selectionRectangle)
-        # scale the selection to current zoom
-        upperLeft = selectionRectangle.topleft
-        zoomedUpperLeft = [x * self.zoom for x in upperLeft]
-        size = selectionRectangle.size
-        zoomedSize = [x * self.zoom for x in size]
-        zoomedSelection = pygame.transform.scale(selection, zoomedSize)
-        # redraw currently displayed image
-        self.zoomedImage.blit(zoomedSelection, zoomedUpperLeft)
-        self.redraw(zoomedSelection.get_rect())
+        # zoom again only tiles in the selection rectangle
+        self.tiles.invalidate(selectionRectangle)
+        # redraw the selection rectangle on the screen
+        zoomedSelection = pygame.Rect([x * self.zoom for x in selectionRectangle.topleft],
+                [x * self.zoom for x in selectionRectangle.size])
+        self.redraw(zoomedSelection.move(self.shift[0], self.shift[1]))
 
     def undo(self):
         if not self.routes:
             return
-        self.routes.pop()
+        route = self.routes.pop()
         self.changedImage = self.image.copy()
         for c in self.routes:
             c.draw(self.changedImage)
-        velikost = [x * self.zoom for x in self.changedImage.get_size()]
-        self.zoomedImage = pygame.transform.scale(self.changedImage, velikost)
+        # only pixels of the removed route changed
+        self.tiles.invalidate(route.boundary())
         self.redraw()
 
     def redo(self):
@@ -364,12 +429,19 @@ class Manager:
         windowRectangle = self.window.get_rect()
         if not selection:
             selection = windowRectangle
-        imageRectangle = self.zoomedImage.get_rect().move(self.shift[0], self.shift[1])
         # fill whole screan with background color
         pygame.draw.rect(window, self.backgroundColor, selection)
         
-        # draw image
-        window.blit(self.zoomedImage, imageRectangle)
+        # draw visible tiles of the zoomed image
+        size = self.tiles.tileSize(self.zoom)
+        zoomedSize = size * self.zoom
+        imageRectangle = pygame.Rect(self.shift, [x * self.zoom for x in self.changedImage.get_size()])
+        visible = selection.clip(imageRectangle).move(-self.shift[0], -self.shift[1])
+        if visible.width > 0 and visible.height > 0:
+            for row in xrange(visible.top / zoomedSize, (visible.bottom - 1) / zoomedSize + 1):
+                for column in xrange(visible.left / zoomedSize, (visible.right - 1) / zoomedSize + 1):
+                    tile = self.tiles.get(self.changedImage, self.zoom, column, row)
+                    window.blit(tile, (column * zoomedSize + self.shift[0], row * zoomedSize + self.shift[1]))
         
         # display filename
         text = font.render(self.filenames.filePosition() + ": " + self.filenames.currentImageFile(), True, pygame.Color(0x00000000))
@@ -396,10 +468,6 @@ def createWindow():
     
     return window
 
-def loadImage(imagePath):
-    obrazek = pygame.image.load(imagePath).convert()
-    return obrazek
-
 def usage():
     print "Usage: colors.py DIRECTORY"
     print "    DIRECTORY Directory with images to colorize."
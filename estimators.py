@@ -0,0 +1,40 @@
+"""Estimators of length of digital curves.
+
+Curve is described by its Freeman chain code. Code of a step to the right
+is 0 and codes grow counterclockwise by 45 degrees, so even codes are
+direct steps and odd codes are diagonal steps. Estimators weight number of
+direct steps, number of diagonal steps and number of corners, that is
+number of changes of direction along the curve."""
+import math
+import numpy
+
+# name -> weights of (direct steps, diagonal steps, corners)
+ESTIMATORS = {
+    # direct step is one pixel long, diagonal step is sqrt(2) pixels long
+    "freeman": (1.0, math.sqrt(2), 0.0),
+    # unbiased for long straight lines in random directions (Kulpa, 1977)
+    "kulpa": (0.948, 1.343, 0.0),
+    # corrected by number of corners (Vossepoel and Smeulders, 1982)
+    "corners": (0.980, 1.406, -0.091),
+    }
+
+DEFAULT = "freeman"
+
+def count_steps(codes, last = None):
+    """Count direct steps, diagonal steps and corners of chain 'codes'.
+
+    'last' is the code of the step before the chain, the first step is a
+    corner if its direction differs. Returns tuple (direct, diagonal,
+    corners, last) where 'last' is the code of the last step."""
+    if not len(codes):
+        return 0, 0, 0, last
+    diagonal = int(numpy.count_nonzero(codes & 1))
+    corners = int(numpy.count_nonzero(codes[1:] != codes[:-1]))
+    if last is not None and codes[0] != last:
+        corners += 1
+    return len(codes) - diagonal, diagonal, corners, int(codes[-1])
+
+def length(direct, diagonal, corners, estimator = DEFAULT):
+    """Return length of a curve in pixels."""
+    weights = ESTIMATORS[estimator]
+    return weights[1] * diagonal + weights[0] * direct + weights[2] * corners
@@ -0,0 +1,184 @@
+"""Graph of a traced skeleton.
+
+Crossroads of the skeleton are nodes of the graph and sections of the
+skeleton between crossroads (or between a crossroad and a tail) are its
+edges. The graph is stored in flat integer arrays in compressed sparse row
+form, pixels of all edges are stored in one array and each edge refers to
+its run of pixels by an offset. The graph can be saved to a file and loaded
+again, so the skeleton does not have to be traced again to measure it with
+other dpi or colors."""
+from array import array
+import numpy
+
+# missing node at the end of an edge that leads to a tail of the skeleton
+NONE = -1
+
+# Freeman code of a step indexed by (dy + 1) * 3 + dx + 1, see estimators.py
+_FREEMAN = numpy.array([3, 2, 1, 4, 255, 0, 5, 6, 7], dtype=numpy.uint8)
+
+class SkeletonGraph:
+    """Crossroads and branches of a skeleton.
+
+    Nodes are numbered from 0 in order they were found, the same holds for
+    edges. Edge has a start node and an end node, pixels of the edge are
+    stored in order from the start node to the end node and they do not
+    include pixels of the nodes. Edge 0 starts at the begining of the root
+    and has no start node."""
+
+    def __init__(self, size, node_pixels, node_offsets, node_edges,
+            edge_nodes, edge_offsets, edge_pixels):
+        self._size = tuple(size)
+        self._node_pixels = node_pixels # pixel index of each node
+        self._node_offsets = node_offsets # node_edges of node i start here
+        self._node_edges = node_edges # edges of all nodes
+        self._edge_nodes = edge_nodes # start and end node of each edge
+        self._edge_offsets = edge_offsets # edge_pixels of edge i start here
+        self._edge_pixels = edge_pixels # pixel indexes of all edges
+        self._codes = None # chain codes of all edges, see chain()
+        self._code_offsets = None # codes of edge i start here
+
+    @classmethod
+    def from_lists(cls, size, nodes, edges):
+        """Create graph from lists.
+
+        'nodes' is a list of (pixel, edges) tuples where 'edges' is a list
+        of edges of the node. 'edges' is a list of (start, end, pixels)
+        tuples, missing nodes are NONE."""
+        node_pixels = array("i", [pixel for pixel, e in nodes])
+        node_offsets = array("i", [0])
+        node_edges = array("i")
+        for pixel, e in nodes:
+            node_edges.extend(e)
+            node_offsets.append(len(node_edges))
+        edge_nodes = array("i")
+        edge_offsets = array("i", [0])
+        edge_pixels = array("i")
+        for start, end, pixels in edges:
+            edge_nodes.append(start)
+            edge_nodes.append(end)
+            edge_pixels.extend(pixels)
+            edge_offsets.append(len(edge_pixels))
+        return cls(size, node_pixels, node_offsets, node_edges,
+                edge_nodes, edge_offsets, edge_pixels)
+
+    def size(self):
+        """Return (width, height) of the image of the skeleton."""
+        return self._size
+
+    def nodes_count(self):
+        return len(self._node_pixels)
+
+    def edges_count(self):
+        return len(self._edge_offsets) - 1
+
+    def node_pixel(self, node):
+        """Return index of pixel of given node."""
+        return self._node_pixels[node]
+
+    def node_edges(self, node, edge = None):
+        """Return edges of given node except 'edge'."""
+        edges = self._node_edges[self._node_offsets[node]:self._node_offsets[node + 1]]
+        return [e for e in edges if e != edge]
+
+    def start(self, edge):
+        return self._edge_nodes[2 * edge]
+
+    def end(self, edge):
+        return self._edge_nodes[2 * edge + 1]
+
+    def opposite(self, edge, node = NONE):
+        """Return node at the other end of 'edge' than 'node'."""
+        if node == self._edge_nodes[2 * edge]:
+            return self._edge_nodes[2 * edge + 1]
+        return self._edge_nodes[2 * edge]
+
+    def length(self, edge):
+        """Return number of pixels of given edge."""
+        return self._edge_offsets[edge + 1] - self._edge_offsets[edge]
+
+    def first_pixel(self, edge, node = NONE):
+        """Return first pixel of 'edge' when going from 'node'.
+
+        Edge without pixels continues directly with the opposite node."""
+        begin = self._edge_offsets[edge]
+        end = self._edge_offsets[edge + 1]
+        if node == self._edge_nodes[2 * edge]:
+            if begin == end:
+                return self._node_pixels[self._edge_nodes[2 * edge + 1]]
+            return self._edge_pixels[begin]
+        else:
+            if begin == end:
+                return self._node_pixels[self._edge_nodes[2 * edge]]
+            return self._edge_pixels[end - 1]
+
+    def pixels(self, edge, node = NONE):
+        """Return pixels of 'edge' in order when going from 'node'."""
+        pixels = self._edge_pixels[self._edge_offsets[edge]:self._edge_offsets[edge + 1]]
+        if node != self._edge_nodes[2 * edge]:
+            pixels.reverse()
+        return pixels
+
+    def chain(self, edge, node = NONE):
+        """Return Freeman chain code of 'edge' when going from 'node'.
+
+        Code i is the direction of the step to i-th pixel of the edge and
+        the last code is the step to the opposite node. There is no step to
+        the first pixel if the edge is not entered from a node. Codes of all
+        edges are computed at once when they are needed for the first time."""
+        if self._codes is None:
+            self._chain_codes()
+        codes = self._codes[self._code_offsets[edge]:self._code_offsets[edge + 1]]
+        if node != self._edge_nodes[2 * edge]:
+            # steps in the opposite direction
+            codes = (codes[::-1] + 4) & 7
+        return codes
+
+    def _chain_codes(self):
+        # pixels of each edge including its nodes
+        sequences = array("i")
+        lengths = []
+        for edge in xrange(self.edges_count()):
+            start = len(sequences)
+            if self._edge_nodes[2 * edge] != NONE:
+                sequences.append(self._node_pixels[self._edge_nodes[2 * edge]])
+            sequences.extend(self._edge_pixels[self._edge_offsets[edge]:self._edge_offsets[edge + 1]])
+            if self._edge_nodes[2 * edge + 1] != NONE:
+                sequences.append(self._node_pixels[self._edge_nodes[2 * edge + 1]])
+            lengths.append(len(sequences) - start)
+        y, x = numpy.divmod(numpy.frombuffer(sequences, dtype=numpy.intc),
+                self._size[0])
+        steps = (numpy.diff(y) + 1) * 3 + numpy.diff(x) + 1
+        # drop steps between the last pixel of an edge and the first pixel
+        # of the next edge
+        ends = numpy.cumsum(lengths)
+        keep = numpy.ones(len(steps), dtype=bool)
+        keep[ends[:-1] - 1] = False
+        self._codes = _FREEMAN[steps[keep]]
+        self._code_offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.intp)
+        numpy.cumsum(numpy.maximum(numpy.array(lengths) - 1, 0),
+                out=self._code_offsets[1:])
+
+    def indexes(self):
+        """Return array of indexes of all pixels of the skeleton."""
+        return numpy.concatenate((
+                numpy.frombuffer(self._edge_pixels, dtype=numpy.intc),
+                numpy.frombuffer(self._node_pixels, dtype=numpy.intc)))
+
+    def save(self, filename):
+        """Save the graph into numpy .npz file 'filename'."""
+        arrays = {}
+        for name in ("node_pixels", "node_offsets", "node_edges",
+                "edge_nodes", "edge_offsets", "edge_pixels"):
+            arrays[name] = numpy.frombuffer(getattr(self, "_" + name),
+                    dtype=numpy.intc)
+        numpy.savez_compressed(filename, size=numpy.array(self._size), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load graph saved by save()."""
+        data = numpy.load(filename)
+        def load(name):
+            return array("i", data[name].astype(numpy.intc).tobytes())
+        return cls(data["size"].tolist(), load("node_pixels"),
+                load("node_offsets"), load("node_edges"), load("edge_nodes"),
+                load("edge_offsets"), load("edge_pixels"))
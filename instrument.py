@@ -0,0 +1,128 @@
+"""Timing and counters of the analysis of images.
+
+Analyzer reports the stages it runs and the numbers it counts to a
+Recorder. For every stage the recorder measures wall time, CPU time and
+the peak memory of the process at the end of the stage. Each stage and
+each counter is passed to hooks as soon as it is recorded and all records
+of one image can be written as one line of JSON (JSON Lines), so large
+batches of images can be examined for images and stages that take the
+most time."""
+import contextlib
+import json
+import os
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not measured there
+    resource = None
+
+def cpu_time():
+    """Return user and system CPU time of the process in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+def peak_memory():
+    """Return peak resident memory of the process in bytes or None if it
+    cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS reports bytes, other systems kilobytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class Recorder:
+    """Stages and counters of the analysis of one image.
+
+    A stage is measured by 'with recorder.stage(name):', counters are set
+    by count(). Every hook is called as hook(event) with a dictionary that
+    has key "event" set to "stage" or "count", key "image" with the name of
+    the image and the recorded values, see stage() and count(). Hooks run
+    in the process that analyzes the image."""
+
+    def __init__(self, image = None, hooks = ()):
+        self._image = image
+        self._hooks = list(hooks)
+        self._stages = [] # records of finished stages in order
+        self._counters = {}
+        self._wall = time.time()
+        self._cpu = cpu_time()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure stage 'name' of the analysis.
+
+        Record of the stage has keys "stage", "wall" and "cpu" (times in
+        seconds) and "peak" (peak memory of the process in bytes). Stages
+        can be nested, a stage is recorded when it ends."""
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            record = {"stage": name, "wall": time.time() - wall,
+                    "cpu": cpu_time() - cpu, "peak": peak_memory()}
+            self._stages.append(record)
+            self._emit("stage", record)
+
+    def count(self, name, value):
+        """Set counter 'name' to 'value', the event has keys "name" and
+        "value"."""
+        self._counters[name] = value
+        self._emit("count", {"name": name, "value": value})
+
+    def stages(self):
+        return list(self._stages)
+
+    def counters(self):
+        return dict(self._counters)
+
+    def record(self, error = None):
+        """Return dictionary with all stages and counters of the image,
+        total times since the recorder was created and the peak memory.
+        'error' is the message of an error that stopped the analysis."""
+        return {"image": self._image, "stages": self.stages(),
+                "counters": self.counters(), "wall": time.time() - self._wall,
+                "cpu": cpu_time() - self._cpu, "peak": peak_memory(),
+                "error": error}
+
+    def _emit(self, event, values):
+        if not self._hooks:
+            return
+        values = dict(values, event=event, image=self._image)
+        for hook in self._hooks:
+            hook(values)
+
+def timings_path(stats):
+    """Return path of the JSON Lines file written next to csv file 'stats'."""
+    return os.path.splitext(stats)[0] + ".jsonl"
+
+def write_record(f, record):
+    """Write 'record' into open file 'f' as one line of JSON."""
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+
+def open_records(path, replaced):
+    """Open JSON Lines file 'path' for writing records of images.
+
+    Records of images in 'replaced' are removed from the file because they
+    are written again, records of other images are kept, so images that
+    are not analyzed again keep their records. Returns the file open for
+    writing after the kept records."""
+    kept = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    image = json.loads(line).get("image")
+                except ValueError:
+                    # line cut off by an interrupted run
+                    continue
+                if image not in replaced:
+                    kept.append(line)
+    f = open(path, "w")
+    f.writelines(kept)
+    return f
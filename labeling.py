@@ -0,0 +1,296 @@
+"""Connected component labeling of two dimensional masks.
+
+Pixels are labeled with a run-length based two-pass algorithm. The first
+pass splits each row into runs of pixels with the same value. The second
+pass merges runs that touch a run of the same value in the next row using
+a vectorized union-find. All work is done on numpy arrays, there is no
+Python level loop over pixels."""
+import numpy
+
+def label(mask, eight = False):
+    """Split pixels of 'mask' into groups of connected pixels with the
+    same value.
+
+    'mask' is a two dimensional array. Pixels are connected through their
+    four direct neighbours or, if 'eight' is True, through all eight
+    neighbours. Returns tuple (labels, count) where 'labels' is an int32
+    array of the same shape as 'mask'. Groups are numbered from 1 to
+    'count' in order of their first pixel (top to bottom, left to right)."""
+    mask = numpy.asarray(mask)
+    if mask.size == 0:
+        return numpy.zeros(mask.shape, dtype=numpy.int32), 0
+    runs, count = _runs(mask)
+    parent = numpy.arange(count, dtype=numpy.int32)
+    first, second = _edges(mask, runs, eight)
+    _merge(parent, first, second)
+    # runs are ordered by their first pixel and every group is rooted in
+    # its first run, so numbering roots in order numbers groups in order
+    roots = parent == numpy.arange(count, dtype=numpy.int32)
+    numbers = numpy.cumsum(roots, dtype=numpy.int32)
+    return numbers[parent][runs], int(numbers[-1])
+
+def prune(mask, threshold, eight = False):
+    """Switch value of all groups with at most 'threshold' pixels.
+
+    Switching a group merges it with its neighbours, which can create
+    new small groups, so groups are switched until no small group remains.
+    The result is the same as labeling the mask again after each round.
+    Component sizes are computed once, later rounds work only with the
+    graph of neighbouring groups, see _prune_graph().
+
+    'mask' must contain only values 0 and 1 and it is modified in place.
+    Returns tuple (labels, count, pruned, rounds) where 'labels' and
+    'count' are the same as returned by label() for the final mask,
+    'pruned' is the total number of switched groups and 'rounds' is the
+    number of rounds of switching."""
+    labels, count = label(mask, eight)
+    sizes = numpy.bincount(labels.ravel(), minlength=count + 1)
+    values = numpy.zeros(count + 1, dtype=numpy.uint8)
+    values[labels.ravel()] = mask.ravel()
+    parent = numpy.arange(count + 1, dtype=numpy.int32)
+    first, second = _adjacent(labels, eight)
+    pruned, rounds = _prune_graph(parent, sizes, values, first, second,
+            threshold)
+    mask[...] = values[labels]
+    # groups are rooted in their smallest label, which is also the label
+    # with the first pixel, so numbering roots in order keeps the order
+    roots = parent == numpy.arange(count + 1, dtype=numpy.int32)
+    roots[0] = False
+    numbers = numpy.cumsum(roots, dtype=numpy.int32)
+    return numbers[parent][labels], int(numbers[-1]), pruned, rounds
+
+def prune_strips(read, height, threshold, strip = 256, eight = False):
+    """Prune a mask that is read in strips of rows, see prune().
+
+    'read(top, bottom)' returns rows 'top' to 'bottom' (exclusive) of the
+    mask as a two dimensional array with values 0 and 1. Each strip is
+    labeled separately and labels that touch across the seam between two
+    strips are joined, so only one strip of pixels is held in memory
+    together with sizes and neighbours of the groups. The mask is read
+    twice, once to find the groups and once to produce the result.
+
+    Returns tuple (strips, pruned, rounds) where 'strips' is a generator of
+    pruned strips of the mask from top to bottom, 'pruned' and 'rounds' are
+    the same as returned by prune(). The pruned mask is the same as the one
+    computed by prune()."""
+    offsets = [0] # label of the first group of each strip minus one
+    sizes = [numpy.zeros(1, dtype=numpy.intp)]
+    values = [numpy.zeros(1, dtype=numpy.uint8)]
+    firsts = []
+    seconds = []
+    above = None # labels of the last row of the previous strip
+    for top in xrange(0, height, strip):
+        rows = numpy.asarray(read(top, min(top + strip, height)))
+        labels, count = label(rows, eight)
+        labels += offsets[-1]
+        offsets.append(offsets[-1] + count)
+        sizes.append(numpy.bincount(labels.ravel() - offsets[-2],
+                minlength=count + 1)[1:])
+        value = numpy.zeros(count + 1, dtype=numpy.uint8)
+        value[labels.ravel() - offsets[-2]] = rows.ravel()
+        values.append(value[1:])
+        first, second = _adjacent(labels, eight)
+        firsts.append(first)
+        seconds.append(second)
+        if above is not None:
+            # neighbouring pixels of the seam with the same value belong to
+            # one group, pixels with different values are neighbours
+            first, second = _adjacent(numpy.vstack((above, labels[:1])), eight)
+            firsts.append(first)
+            seconds.append(second)
+        above = labels[-1:].copy()
+    count = offsets[-1]
+    sizes = numpy.concatenate(sizes)
+    values = numpy.concatenate(values)
+    first = numpy.concatenate(firsts)
+    second = numpy.concatenate(seconds)
+    # join groups split by seams
+    parent = numpy.arange(count + 1, dtype=numpy.int32)
+    joined = values[first] == values[second]
+    _merge(parent, first[joined], second[joined])
+    first = first[~joined]
+    second = second[~joined]
+    pruned, rounds = _prune_graph(parent, sizes, values, first, second,
+            threshold)
+
+    def strips():
+        for i, top in enumerate(xrange(0, height, strip)):
+            rows = numpy.asarray(read(top, min(top + strip, height)))
+            labels, count = label(rows, eight)
+            labels += offsets[i]
+            yield values[labels]
+    return strips(), pruned, rounds
+
+def label_points(indexes, width, eight = False):
+    """Split pixels with flat 'indexes' into groups of connected pixels.
+
+    Only listed pixels are foreground, 'width' is width of the image and
+    'indexes' must be sorted. Work depends on the number of listed pixels,
+    not on the size of the image. Returns tuple (labels, count) where
+    labels[i] is the group of pixel indexes[i]. Groups are numbered from 1
+    to 'count' in order of their first pixel."""
+    indexes = numpy.asarray(indexes, dtype=numpy.int64)
+    if indexes.size == 0:
+        return numpy.zeros(0, dtype=numpy.int32), 0
+    x = indexes % width
+    # right and bottom neighbours, every pair of pixels is found once
+    steps = [(1, 0), (0, 1)]
+    if eight:
+        steps.extend([(-1, 1), (1, 1)])
+    first = []
+    second = []
+    for dx, dy in steps:
+        positions = find_points(indexes, indexes + dy * width + dx)
+        found = (positions >= 0) & (x + dx >= 0) & (x + dx < width)
+        first.append(numpy.flatnonzero(found).astype(numpy.int32))
+        second.append(positions[found].astype(numpy.int32))
+    parent = numpy.arange(indexes.size, dtype=numpy.int32)
+    _merge(parent, numpy.concatenate(first), numpy.concatenate(second))
+    roots = parent == numpy.arange(indexes.size, dtype=numpy.int32)
+    numbers = numpy.cumsum(roots, dtype=numpy.int32)
+    return numbers[parent], int(numbers[-1])
+
+def find_points(indexes, targets):
+    """Return positions of 'targets' in sorted array 'indexes'. Position
+    of a target that is not in 'indexes' is -1."""
+    positions = numpy.searchsorted(indexes, targets)
+    positions[positions == len(indexes)] = 0
+    return numpy.where(indexes[positions] == targets, positions, -1)
+
+def members(labels, count):
+    """Return list of arrays of pixel indexes for each group in 'labels'.
+
+    The i-th array holds flat indexes of pixels with label i + 1 in
+    increasing order."""
+    labels = numpy.asarray(labels).ravel()
+    order = numpy.argsort(labels, kind="mergesort")
+    sizes = numpy.bincount(labels, minlength=count + 1)
+    # pixels with label 0 do not belong to any group
+    order = order[sizes[0]:]
+    return numpy.split(order, numpy.cumsum(sizes[1:-1]))
+
+def _runs(mask):
+    """Assign each pixel an index of its run.
+
+    Run is a horizontal section of pixels with the same value. Returns
+    tuple (runs, count) where 'runs' has the same shape as 'mask'."""
+    h, w = mask.shape
+    flat = mask.ravel()
+    starts = numpy.empty(flat.size, dtype=bool)
+    starts[0] = True
+    numpy.not_equal(flat[1:], flat[:-1], out=starts[1:])
+    starts[::w] = True # every row starts with a new run
+    runs = numpy.cumsum(starts, dtype=numpy.int32)
+    runs -= 1
+    return runs.reshape(h, w), int(runs[-1]) + 1
+
+def _edges(mask, runs, eight):
+    """Find pairs of runs that touch each other and have the same value.
+
+    Returns tuple of two arrays, runs first[i] and second[i] touch."""
+    # (rows of upper pixels, rows of lower pixels) for each direction
+    shifts = [((slice(None), slice(None)), (slice(None), slice(None)))]
+    if eight:
+        # lower right and lower left diagonal neighbours
+        shifts.append(((slice(None), slice(None, -1)), (slice(None), slice(1, None))))
+        shifts.append(((slice(None), slice(1, None)), (slice(None), slice(None, -1))))
+    upper_mask, lower_mask = mask[:-1], mask[1:]
+    upper_runs, lower_runs = runs[:-1], runs[1:]
+    first = []
+    second = []
+    for upper, lower in shifts:
+        same = upper_mask[upper] == lower_mask[lower]
+        a = upper_runs[upper][same]
+        b = lower_runs[lower][same]
+        # neighbouring pixels of two long runs produce the same pair many
+        # times, keep only the first one
+        keep = numpy.ones(a.size, dtype=bool)
+        keep[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+        first.append(a[keep])
+        second.append(b[keep])
+    return numpy.concatenate(first), numpy.concatenate(second)
+
+def _adjacent(labels, eight):
+    """Find pairs of different labels of neighbouring pixels.
+
+    Returns tuple of two arrays, labels first[i] and second[i] touch. Every
+    pair is returned once."""
+    # (first pixels, second pixels) for each direction
+    shifts = [
+            ((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+            ((slice(None, -1), slice(None)), (slice(1, None), slice(None)))
+            ]
+    if eight:
+        shifts.append(((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))))
+        shifts.append(((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1))))
+    first = []
+    second = []
+    for a, b in shifts:
+        border = labels[a] != labels[b]
+        first.append(labels[a][border])
+        second.append(labels[b][border])
+    first = numpy.concatenate(first).astype(numpy.int64)
+    second = numpy.concatenate(second).astype(numpy.int64)
+    # most pairs repeat along the border of a group
+    pairs = numpy.unique(numpy.minimum(first, second) << 32 | numpy.maximum(first, second))
+    return (pairs >> 32).astype(numpy.int32), (pairs & 0xffffffff).astype(numpy.int32)
+
+def _prune_graph(parent, sizes, values, first, second, threshold):
+    """Switch groups with at most 'threshold' pixels in a graph of groups.
+
+    Labels 1 to len(parent) - 1 are nodes of the graph, label 0 is unused.
+    'parent' joins labels into groups (see _merge()), 'sizes' are numbers
+    of pixels and 'values' are values of the labels. Labels first[i] and
+    second[i] are neighbours with different values. 'parent' and 'values'
+    are modified in place. Switching a group merges it with the groups
+    around it. Returns tuple (pruned, rounds) of number of switched groups
+    and number of rounds in which they were switched."""
+    count = len(parent) - 1
+    labels = numpy.arange(count + 1, dtype=numpy.int32)
+    pruned = 0
+    rounds = 0
+    while True:
+        totals = numpy.bincount(parent, weights=sizes, minlength=count + 1)
+        small = totals[parent] <= threshold
+        small[0] = False
+        roots = numpy.count_nonzero(parent[1:] == labels[1:])
+        if roots <= 1 or not small.any():
+            # nothing to prune or there is nothing to merge with
+            return pruned, rounds
+        rounds += 1
+        pruned += numpy.count_nonzero(small & (parent == labels))
+        values[small] ^= 1
+        # switched groups join neighbours that were not switched
+        border = small[first] != small[second]
+        _merge(parent, first[border], second[border])
+
+def _merge(parent, first, second):
+    """Join runs first[i] and second[i] into the same group.
+
+    'parent' is modified in place. At the end every run points directly
+    to the root of its group and the root is the smallest run of the
+    group."""
+    while first.size:
+        a = parent[first]
+        b = parent[second]
+        differ = a != b
+        if not differ.any():
+            break
+        first = first[differ]
+        second = second[differ]
+        a = a[differ]
+        b = b[differ]
+        # attach root with larger index to the smallest root it touches,
+        # a root that touches several roots must keep the smallest of them,
+        # plain assignment would keep only one of them and link one root
+        # per pass
+        numpy.minimum.at(parent, numpy.maximum(a, b), numpy.minimum(a, b))
+        _compress(parent)
+
+def _compress(parent):
+    """Make every run point directly to the root of its group."""
+    while True:
+        grandparent = parent[parent]
+        if numpy.array_equal(grandparent, parent):
+            return
+        parent[:] = grandparent
@@ -0,0 +1,39 @@
+"""Running of per-image tasks in a pool of processes."""
+import multiprocessing
+from collections import deque
+
+def jobs_count(jobs):
+    """Return number of processes to use for 'jobs' given on command line.
+
+    Zero or negative number means one process for each CPU."""
+    return jobs if jobs > 0 else multiprocessing.cpu_count()
+
+def imap(function, tasks, jobs = 1, inflight = None):
+    """Call function(*task) for each task in 'tasks' and yield the results
+    in the order of tasks.
+
+    If 'jobs' is greater than one, tasks are processed by a pool of 'jobs'
+    processes. At most 'inflight' tasks (twice the number of jobs by
+    default) are submitted ahead of the result that is yielded next, so
+    only a bounded number of images is held in memory at once. 'function'
+    must be defined at module level so that it can be passed to the worker
+    processes."""
+    if jobs <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    if not inflight:
+        inflight = 2 * jobs
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, task))
+            if len(pending) >= inflight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
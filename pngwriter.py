@@ -0,0 +1,69 @@
+"""Streaming writer of png images.
+
+Rows of the image are compressed and written to the file as they come, so
+the whole image never has to be held in memory at once."""
+import struct
+import zlib
+
+class PngWriter:
+    """Png image opened for writing rows from top to bottom.
+
+    Only 8 bit grayscale ("L") and 8 bit RGB ("RGB") images are supported.
+    Rows are passed as strings with one byte for each channel of each
+    pixel."""
+
+    _MODES = {"L": (0, 1), "RGB": (2, 3)} # mode -> (color type, channels)
+
+    def __init__(self, filename, size, mode = "L"):
+        if mode not in self._MODES:
+            raise ValueError("Unsupported mode '%s'." % (mode))
+        colorType, channels = self._MODES[mode]
+        self._width, self._height = size
+        self._stride = self._width * channels
+        self._rows = 0 # number of rows written so far
+        self._compressor = zlib.compressobj(6)
+        self._file = open(filename, "wb")
+        self._file.write("\x89PNG\r\n\x1a\n")
+        # bit depth 8, default compression, filtering and no interlacing
+        self._chunk("IHDR", struct.pack(">IIBBBBB", self._width, self._height,
+                8, colorType, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind:
+            self._file.close()
+        else:
+            self.close()
+
+    def write(self, rows):
+        """Append whole rows of pixels to the image."""
+        count = len(rows) // self._stride
+        if count * self._stride != len(rows):
+            raise ValueError("Data do not contain whole rows.")
+        if self._rows + count > self._height:
+            raise ValueError("Too many rows.")
+        # every row starts with filter type, 0 means no filter
+        filtered = "".join("\x00" + rows[i:i + self._stride]
+                for i in xrange(0, len(rows), self._stride))
+        self._data(self._compressor.compress(filtered))
+        self._rows += count
+
+    def close(self):
+        """Finish the image and close the file."""
+        if self._rows != self._height:
+            self._file.close()
+            raise ValueError("Image has %d rows, expected %d." % (self._rows, self._height))
+        self._data(self._compressor.flush())
+        self._chunk("IEND", "")
+        self._file.close()
+
+    def _data(self, data):
+        if data:
+            self._chunk("IDAT", data)
+
+    def _chunk(self, kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        self._file.write(struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", crc))
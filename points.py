@@ -3,6 +3,24 @@ import pygame
 import os
 import sys
 import math
+import threading
+import hashlib
+import json
+import mmap
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        # sha1 is used instead
+        blake2b = None
+try:
+    from PIL import Image
+except ImportError:
+    # images are decoded at full resolution by pygame
+    Image = None
+from prefetch import ImageCache
 
 class FileList:
     """Class representing a list of image files. """
@@ -68,6 +86,15 @@ class FileList:
         """Returns true if currently displayed file is the first one in the list."""
         return self.position <= 0
 
+    def nearbyImageFiles(self, count):
+        """Returns up to 'count' next and 'count' previous files, the closest first."""
+        files = []
+        for i in xrange(1, count + 1):
+            for position in (self.position + i, self.position - i):
+                if position >= 0 and position < len(self.imageFiles):
+                    files.append(self.imageFiles[position])
+        return files
+
 class SelectedPoint:
     """Class representing a point selected in the image."""
 
@@ -211,6 +238,7 @@ class Record:
         self.filename = ""
         self.hash = 0
         self.points = [(-1, -1), (-1, -1), (-1, -1), (-1, -1)] # -1,-1 means not initialized
+        self.newHash = 0 # hash of the image if it changed since the points were selected
 
     def set(self, imageFile, imageHash):
         self.filename = imageFile
@@ -227,13 +255,37 @@ class Record:
                 y = int(columns[2 + i*2 + 1])
                 self.points[i] = ((x, y))
 
+    @staticmethod
+    def lineHash(line):
+        """Return hash of the image saved in 'line' without parsing the
+        rest of the line, 0 if the line has no hash."""
+        columns = line.split(",")
+        if len(columns) == 10:
+            return int(columns[1])
+        return 0
+
     def save(self):
         radek = "%s,%d" % (self.filename, self.hash)
         for bod in self.points:
             radek = radek + ",%d,%d" % bod
         return radek
 
+    def setHash(self, imageHash):
+        """Set hash of the image the first time it is known, if the image
+        changed since then, mark the record as changed."""
+        if self.hash == 0:
+            self.hash = imageHash
+        elif self.hash != imageHash:
+            self.newHash = imageHash
+
+    def isChanged(self):
+        return self.newHash != 0
+
     def setPoints(self, selectedPoints, ratio, x0, y0):
+        # the points were shown with the changed image
+        if self.newHash != 0:
+            self.hash = self.newHash
+            self.newHash = 0
         index = 0
         for point in selectedPoints.points:
             if point.isVisible:
@@ -247,47 +299,243 @@ class Record:
 
 
 class Database:
-    """Database of point records for multiple image files."""
+    """Database of point records for multiple image files.
+
+    Records are stored in a csv file. Saving does not rewrite the file,
+    changed records are appended to a journal next to it instead. When the
+    journal is long, the csv file is rewritten with all records in a
+    background thread and a new journal is started. Lines of the file are
+    parsed into records only when the records are needed."""
+
+    """Number of lines in the journal after which the csv file is rewritten."""
+    COMPACT_LINES = 1000
 
     def __init__(self, dbFilename):
         """Create new database in given file or load it if the file already exists."""
-        self.records = {}
+        self.records = {} # parsed records
+        self.lines = {} # filename -> saved line of each record
+        self.pending = {} # records returned by getRecord() since the last save
         self.dbFilename = dbFilename
-        if os.path.exists(dbFilename) and os.path.isfile(dbFilename):
+        self.journalFilename = dbFilename + ".journal"
+        # journal that is being written into the csv file
+        self.compactedFilename = dbFilename + ".journal.old"
+        self.journalLines = 0
+        self.compaction = None # thread that rewrites the csv file
+        journals = [f for f in (self.compactedFilename, self.journalFilename) if os.path.isfile(f)]
+        if os.path.exists(dbFilename) and os.path.isfile(dbFilename) or journals:
             # nacti zaznamy ze souboru
             print "Loading database file: " + dbFilename
             self.load()
+            if journals:
+                # the program ended without writing records from the journals
+                self.compact()
         else:
             # create empty file with header
             print "Creating database file: " + dbFilename
-            file = open(self.dbFilename, "w")
-            line = Record.header() + "\n"
-            file.write(line)
-            file.close()
+            self.export(self.dbFilename)
+        self.journal = open(self.journalFilename, "a")
 
     def load(self):
-        file = open(self.dbFilename)
-        lines = file.readlines()
-        file.close()
-        for line in lines:
-            line = line.strip()
-            if len(line) > 0 and line[0] != "#":
-                # ignore empty lines and lines starting with #
-                record = Record()
-                record.load(line)
-                self.records[record.filename] = record
+        """Read lines of the csv file and of the journals, later lines of a
+        record replace earlier ones."""
+        for filename in (self.dbFilename, self.compactedFilename, self.journalFilename):
+            if os.path.isfile(filename):
+                file = open(filename)
+                for line in file:
+                    line = line.strip()
+                    if len(line) > 0 and line[0] != "#":
+                        # ignore empty lines and lines starting with #
+                        name = os.path.split(line.split(",", 1)[0])[1] # ignore directory name
+                        self.lines[name] = line
+                file.close()
+
+    def getRecord(self, imageFile, imageHash):
+        """Returns record of given image file, new record is created if the
+        image has none. The record is saved by the next save()."""
+        record = self.records.get(imageFile)
+        if record is None:
+            record = Record()
+            if self.lines.has_key(imageFile):
+                record.load(self.lines[imageFile])
+            else:
+                # no record for this image in the database
+                record.set(imageFile, imageHash)
+            self.records[imageFile] = record
+        self.pending[imageFile] = record
+        return record
+
+    def checkHashes(self, hashes):
+        """Set hashes of images of records in the database, 'hashes' maps
+        image files to hashes. Returns sorted list of image files whose
+        records are marked as changed."""
+        changed = []
+        for imageFile, imageHash in hashes.iteritems():
+            record = self.records.get(imageFile)
+            if record is not None:
+                savedHash = record.hash
+            elif self.lines.has_key(imageFile):
+                # lines are parsed only for records whose hash differs
+                savedHash = Record.lineHash(self.lines[imageFile])
+            else:
+                continue
+            if savedHash != imageHash:
+                # the hash is set or the record is marked as changed, it
+                # is saved by the next save()
+                record = self.getRecord(imageFile, imageHash)
+                record.setHash(imageHash)
+            if record is not None and record.isChanged():
+                changed.append(imageFile)
+        return sorted(changed)
 
     def save(self):
-        file = open(self.dbFilename, "w")
+        """Append records that changed since they were returned by
+        getRecord() to the journal."""
+        for imageFile, record in self.pending.iteritems():
+            line = record.save()
+            if self.lines.get(imageFile) != line:
+                self.lines[imageFile] = line
+                self.journal.write(line + "\n")
+                self.journalLines = self.journalLines + 1
+        self.pending = {}
+        self.journal.flush()
+        if self.journalLines >= Database.COMPACT_LINES:
+            self.startCompaction()
+
+    def close(self):
+        """Save records and rewrite the csv file with all of them."""
+        self.save()
+        if self.compaction is not None:
+            self.compaction.join()
+        self.journal.close()
+        if self.journalLines > 0 or os.path.exists(self.compactedFilename):
+            self.compact()
+        else:
+            os.remove(self.journalFilename)
+
+    def export(self, filename):
+        """Write all saved records into csv file 'filename'."""
+        self.writeLines(filename, self.lines)
+
+    def compact(self):
+        """Rewrite the csv file with all records and remove the journals."""
+        self.export(self.dbFilename)
+        for filename in (self.compactedFilename, self.journalFilename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def startCompaction(self):
+        """Start a new journal and rewrite the csv file in a background thread."""
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        if os.path.exists(self.compactedFilename):
+            # the last compaction failed, journals are written when the
+            # database is closed
+            return
+        self.journal.close()
+        os.rename(self.journalFilename, self.compactedFilename)
+        self.journal = open(self.journalFilename, "a")
+        self.journalLines = 0
+        self.compaction = threading.Thread(target=self.compactLines, args=(dict(self.lines),))
+        self.compaction.start()
+
+    def compactLines(self, lines):
+        try:
+            self.writeLines(self.dbFilename, lines)
+            os.remove(self.compactedFilename)
+        except (IOError, OSError) as e:
+            print "Failed to write database file: %s" % (e)
+
+    def writeLines(self, filename, lines):
+        # the file is replaced at once, so it is never incomplete
+        temporary = filename + ".tmp"
+        file = open(temporary, "w")
         line = Record.header() + "\n"
         file.write(line)
-        keys = sorted(self.records.keys())
+        keys = sorted(lines.keys())
         for key in keys:
-            line = self.records[key].save() + "\n"
+            line = lines[key] + "\n"
             file.write(line)
         file.close()
+        os.rename(temporary, filename)
 
     
+def fileHash(path):
+    """Returns hash of content of file as a positive integer, 0 is never
+    returned. BLAKE2 is used if it is available, sha1 otherwise."""
+    digest = blake2b(digest_size=8) if blake2b is not None else hashlib.sha1()
+    size = os.path.getsize(path)
+    if size > 0:
+        file = open(path, "rb")
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                block = 1 << 20
+                for start in xrange(0, size, block):
+                    digest.update(data[start:start + block])
+            finally:
+                data.close()
+        finally:
+            file.close()
+    return int(digest.hexdigest()[:16], 16) & 0x7fffffffffffffff or 1
+
+
+class ImageHashes:
+    """Hashes of image files computed in a background thread.
+
+    Size, modification time and hash of each file are kept in a cache file,
+    files that did not change since they were hashed are not read again."""
+
+    def __init__(self, cacheFilename):
+        self.cacheFilename = cacheFilename
+        self.cache = {} # image file -> [size, mtime, hash]
+        self.hashes = {} # image file -> hash of files hashed so far
+        self.thread = None
+        if os.path.isfile(cacheFilename):
+            try:
+                file = open(cacheFilename)
+                self.cache = json.load(file)
+                file.close()
+            except ValueError:
+                print "Ignoring damaged hashes file: " + cacheFilename
+
+    def start(self, imagePaths, finished):
+        """Start hashing files 'imagePaths', 'finished' is called from the
+        thread when all of them are hashed."""
+        self.thread = threading.Thread(target=self.hashFiles, args=(list(imagePaths), finished))
+        # do not wait for the thread when the program ends
+        self.thread.daemon = True
+        self.thread.start()
+
+    def hashFiles(self, imagePaths, finished):
+        for imagePath in imagePaths:
+            imageFile = os.path.split(imagePath)[1]
+            try:
+                stat = os.stat(imagePath)
+                cached = self.cache.get(imageFile)
+                if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+                    imageHash = cached[2]
+                else:
+                    imageHash = fileHash(imagePath)
+                    self.cache[imageFile] = [stat.st_size, stat.st_mtime, imageHash]
+            except (IOError, OSError) as e:
+                print "Failed to hash image file: %s" % (e)
+                continue
+            self.hashes[imageFile] = imageHash
+        finished()
+
+    def get(self, imageFile):
+        """Returns hash of given image file or 0 if it is not known yet."""
+        return self.hashes.get(imageFile, 0)
+
+    def save(self):
+        """Save the cache file. It must not be called while the thread runs."""
+        temporary = self.cacheFilename + ".tmp"
+        file = open(temporary, "w")
+        json.dump(self.cache, file)
+        file.close()
+        os.rename(temporary, self.cacheFilename)
+
+
 def createWindow():
     pygame.init()
     pygame.display.init()
@@ -300,16 +548,11 @@ def createWindow():
     pygame.event.set_allowed(pygame.KEYDOWN)
     return window
 
-def loadImage(imagePath):
-    return pygame.image.load(imagePath).convert()
-
-def drawImage(image, window):
-    """Draw image so that it fits into the window. Returns coordinates of upper left corner, scaled image dimensions
-    and scaling ratio."""
-    
-    # get dimensions of the window and the image
-    windowWidth, windowHeight = window.get_size()
-    imageWidth, imageHeight = image.get_size()
+def fitImage(imageSize, windowSize):
+    """Returns coordinates of upper left corner, dimensions and scaling ratio of image of given size scaled so that
+    it fits into the window."""
+    windowWidth, windowHeight = windowSize
+    imageWidth, imageHeight = imageSize
 
     # compute dimension that would fit the window, keep the image size ratio
     if float(windowWidth)/imageWidth > float(windowHeight) / imageHeight:
@@ -324,9 +567,40 @@ def drawImage(image, window):
         imageWidth = windowWidth
         y0 = (windowHeight - imageHeight) / 2
         x0 = 0
+    return (x0, y0, imageWidth, imageHeight, ratio)
+
+def loadScaledImage(imagePath, windowSize):
+    """Load image scaled so that it fits into the window. Returns tuple (scaled image, size of the original image).
+
+    With PIL, jpeg images are decoded at reduced resolution. The image is not converted for the display, so it can
+    be loaded in a background thread."""
+    if Image is not None:
+        image = Image.open(imagePath)
+        imageSize = image.size
+        (x0, y0, imageWidth, imageHeight, ratio) = fitImage(imageSize, windowSize)
+        # jpeg is decoded at the smallest scale that is still larger than the scaled image
+        image.draft("RGB", (imageWidth, imageHeight))
+        image = image.convert("RGB").resize((imageWidth, imageHeight), Image.ANTIALIAS)
+        return (pygame.image.fromstring(image.tobytes(), image.size, "RGB"), imageSize)
+    image = pygame.image.load(imagePath)
+    imageSize = image.get_size()
+    (x0, y0, imageWidth, imageHeight, ratio) = fitImage(imageSize, windowSize)
+    return (pygame.transform.scale(image, (imageWidth, imageHeight)), imageSize)
+
+def drawImage(image, window, imageSize = None):
+    """Draw image so that it fits into the window. If 'imageSize' is given, the image is already scaled and
+    'imageSize' is the size of the original image. Returns coordinates of upper left corner, scaled image dimensions
+    and scaling ratio."""
+    windowWidth, windowHeight = window.get_size()
+    if imageSize is None:
+        imageSize = image.get_size()
+    (x0, y0, imageWidth, imageHeight, ratio) = fitImage(imageSize, (windowWidth, windowHeight))
 
     # scale the image so that it fits the window
-    scaledImage = pygame.transform.scale(image, (imageWidth, imageHeight))
+    if image.get_size() != (imageWidth, imageHeight):
+        scaledImage = pygame.transform.scale(image, (imageWidth, imageHeight))
+    else:
+        scaledImage = image
 
     # fill whole screen with background color
     wholeWindowRectangle = pygame.Rect(0, 0, windowWidth, windowHeight)
@@ -339,34 +613,40 @@ def drawImage(image, window):
     
     return (x0, y0, imageWidth, imageHeight, ratio)
 
-def drawImageFromFile(imagePath, window, database, selectedPoints):
-    imageFilename = os.path.split(imagePath)[1] # just the filename
-    imageHash = 0
-    if database.records.has_key(imageFilename):
-        record = database.records[imageFilename]
+def showCaption(imagePath, record):
+    if record.isChanged():
+        pygame.display.set_caption(imagePath + " (image changed since the points were selected)")
     else:
-        # no record for this image in the database
-        record = Record()
-        record.set(imageFilename, imageHash)
-        database.records[imageFilename] = record
-    image = loadImage(imagePath)
-    (x0, y0, imageWidth, imageHeight, ratio) = drawImage(image, window)
-    pygame.display.set_caption(imagePath)
+        pygame.display.set_caption(imagePath)
+
+def drawImageFromFile(imagePath, window, database, selectedPoints, imageHashes, images):
+    imageFilename = os.path.split(imagePath)[1] # just the filename
+    imageHash = imageHashes.get(imageFilename) # 0 until the image is hashed
+    record = database.getRecord(imageFilename, imageHash)
+    if imageHash != 0:
+        record.setHash(imageHash)
+    (image, imageSize) = images.get(imagePath)
+    (x0, y0, imageWidth, imageHeight, ratio) = drawImage(image, window, imageSize)
+    showCaption(imagePath, record)
     selectedPoints.readPoints(window, record, ratio, x0, y0)
     pygame.display.flip()
     return (x0, y0, imageWidth, imageHeight, ratio, record)
 
-def displayNextImage(fileList, window, databaze, selectedPoints):
+def displayNextImage(fileList, window, databaze, selectedPoints, imageHashes, images):
     """Display next image. There must be an image to display. Returns coordinates of upper left corner,
-    scaled image dimensions and scaling ratio."""
+    scaled image dimensions and scaling ratio. Images around it are loaded in the background."""
     imagePath = fileList.nextImageFile()
-    return drawImageFromFile(imagePath, window, databaze, selectedPoints)
+    result = drawImageFromFile(imagePath, window, databaze, selectedPoints, imageHashes, images)
+    images.prefetch(fileList.nearbyImageFiles(PREFETCH_IMAGES))
+    return result
 
-def displayPreviousImage(fileList, window, databaze, selectedPoints):
+def displayPreviousImage(fileList, window, databaze, selectedPoints, imageHashes, images):
     """Display previous image. There must be a previous image to display. Returns coordinates of upper left corner,
-    scaled image dimensions and scaling ratio."""
+    scaled image dimensions and scaling ratio. Images around it are loaded in the background."""
     imagePath = fileList.previousImageFile()
-    return drawImageFromFile(imagePath, window, databaze, selectedPoints)
+    result = drawImageFromFile(imagePath, window, databaze, selectedPoints, imageHashes, images)
+    images.prefetch(fileList.nearbyImageFiles(PREFETCH_IMAGES))
+    return result
 
 def usage():
     print "Usage: points.py DIRECTORY"
@@ -401,9 +681,18 @@ if fileList.isEnd():
 window = createWindow()
 database = Database(directory[:-1] + ".csv")
 selectedPoints = SelectedPoints()
+imageHashes = ImageHashes(directory[:-1] + ".hashes")
+# event posted when all images are hashed
+HASHES_FINISHED = pygame.USEREVENT
+# number of next and previous images loaded in the background
+PREFETCH_IMAGES = 3
+windowSize = window.get_size()
+images = ImageCache(lambda imagePath: loadScaledImage(imagePath, windowSize), 2 * PREFETCH_IMAGES + 4)
 
 # load and display first image
-(x0, y0, imageWidth, imageHeight, ratio, record) = displayNextImage(fileList, window, database, selectedPoints)
+(x0, y0, imageWidth, imageHeight, ratio, record) = displayNextImage(fileList, window, database, selectedPoints, imageHashes, images)
+# hash all images in the background to find images that changed
+imageHashes.start(fileList.imageFiles, lambda: pygame.event.post(pygame.event.Event(HASHES_FINISHED)))
 
 movedPoint = None
 movedPointHeldAt = (0, 0) # distance of the drag point from the center of the circle
@@ -458,23 +747,29 @@ while(1):
             if not fileList.isEnd():
                 record.setPoints(selectedPoints, ratio, x0, y0)
                 database.save()
-                (x0, y0, imageWidth, imageHeight, ratio, record) = displayNextImage(fileList, window, database, selectedPoints)
+                (x0, y0, imageWidth, imageHeight, ratio, record) = displayNextImage(fileList, window, database, selectedPoints, imageHashes, images)
         elif event.key == pygame.K_LEFT:
             # left arrow => display previous image
             if not fileList.isStart():
                 record.setPoints(selectedPoints, ratio, x0, y0)
                 database.save()
-                (x0, y0, imageWidth, imageHeight, ratio, record) = displayPreviousImage(fileList, window, database, selectedPoints)
+                (x0, y0, imageWidth, imageHeight, ratio, record) = displayPreviousImage(fileList, window, database, selectedPoints, imageHashes, images)
         elif event.key == pygame.K_ESCAPE:
             # esc => end program
             record.setPoints(selectedPoints, ratio, x0, y0)
-            database.save()
+            database.close()
             exit()
         else:
             pass
+    elif event.type == HASHES_FINISHED:
+        # all images are hashed, mark records whose images changed
+        imageHashes.save()
+        for imageFile in database.checkHashes(imageHashes.hashes):
+            print "Image changed since its points were selected: " + imageFile
+        showCaption(fileList.currentImageFile(), record)
     elif event.type == pygame.QUIT:
         # window closed, save and exit
         record.setPoints(selectedPoints, ratio, x0, y0)
-        database.save()
+        database.close()
         exit()
 
@@ -0,0 +1,92 @@
+"""Decoding of images ahead of time in a background thread.
+
+Tools that show images one by one (points.py, colors.py) decode the images
+that will probably be shown next (the next and previous few in the list)
+while the user works on the current one. Decoded images are kept in a
+bounded cache, the least recently used images are dropped first, so moving
+to a neighbouring image does not wait for decoding of a large file."""
+import threading
+from collections import OrderedDict
+
+class ImageCache:
+    """Images decoded by 'decode' in a background thread.
+
+    decode(path) is called in the worker thread for prefetched images and
+    in the calling thread for images that are not cached yet. At most
+    'capacity' decoded images are kept."""
+
+    def __init__(self, decode, capacity = 5):
+        self._decode = decode
+        self._capacity = capacity
+        self._images = OrderedDict() # path -> decoded image, oldest first
+        self._queue = [] # paths to prefetch in order
+        self._decoding = None # path decoded by the worker
+        self._versions = {} # path -> number of discards of the path
+        self._condition = threading.Condition()
+        thread = threading.Thread(target=self._work)
+        # do not wait for the thread when the program ends
+        thread.daemon = True
+        thread.start()
+
+    def get(self, path):
+        """Return decoded image of file 'path'. If the worker decodes it,
+        wait for it, if it is not cached, decode it now."""
+        with self._condition:
+            while self._decoding == path:
+                self._condition.wait()
+            if path in self._images:
+                image = self._images.pop(path)
+                self._images[path] = image # most recently used
+                return image
+            if path in self._queue:
+                self._queue.remove(path)
+            version = self._versions.get(path, 0)
+        image = self._decode(path)
+        self._store(path, image, version)
+        return image
+
+    def prefetch(self, paths):
+        """Decode 'paths' in the background in the given order, paths that
+        were to be prefetched before are forgotten."""
+        with self._condition:
+            self._queue = [path for path in paths if path not in self._images]
+            self._condition.notify_all()
+
+    def discard(self, path):
+        """Drop decoded image of file 'path', for example because the file
+        was written."""
+        with self._condition:
+            self._images.pop(path, None)
+            # image being decoded is not stored
+            self._versions[path] = self._versions.get(path, 0) + 1
+
+    def _store(self, path, image, version):
+        # the condition is reentrant, so the worker can hold it
+        with self._condition:
+            if self._versions.get(path, 0) == version:
+                self._images.pop(path, None)
+                self._images[path] = image
+                while len(self._images) > self._capacity:
+                    self._images.popitem(last=False)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                path = self._queue.pop(0)
+                if path in self._images:
+                    continue
+                self._decoding = path
+                version = self._versions.get(path, 0)
+            image = None
+            try:
+                image = self._decode(path)
+            except Exception as e:
+                # get() decodes the image again and reports the error
+                print "Failed to prefetch image '%s': %s" % (path, e)
+            with self._condition:
+                self._decoding = None
+                if image is not None:
+                    self._store(path, image, version)
+                self._condition.notify_all()
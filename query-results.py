@@ -0,0 +1,32 @@
+#!/usr/bin/python
+import argparse
+import os
+
+from store import summary
+
+if __name__=="__main__":
+    # parse commandline arguments
+    parser = argparse.ArgumentParser(
+            description="Print lengths of sections of roots for each color from a database of measurements.")
+    parser.add_argument("database", type=str, help="SQLite database written by analyze-root.py or analyze-skeleton.py")
+    parser.add_argument("--experiment", type=str, default=None,
+            help="use only sections of this experiment")
+    parser.add_argument("--name", type=str, default=None,
+            help="use only sections of the image with this name")
+    parser.add_argument("--parameters", type=str, default=None,
+            help="use only sections measured with parameters of this hash instead of the latest ones")
+    parser.add_argument("--images", action="store_true",
+            help="print lengths for each image separately")
+    arguments = parser.parse_args()
+    if not os.path.isfile(arguments.database):
+        parser.error("database '%s' does not exist" % (arguments.database))
+
+    rows = summary(arguments.database, arguments.experiment, arguments.name,
+            arguments.parameters, arguments.images)
+    # lengths are in milimeters
+    print ";".join((["jmeno"] if arguments.images else [])
+            + ["barva", "useku", "delka", "prumer", "minimum", "maximum"])
+    for name, color, count, total, mean, minimum, maximum in rows:
+        print ";".join(([name.encode("utf-8")] if arguments.images else [])
+                + [color.encode("utf-8"), "%d" % count, "%0.4f" % total,
+                "%0.4f" % mean, "%0.4f" % minimum, "%0.4f" % maximum])
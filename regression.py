@@ -0,0 +1,182 @@
+#!/usr/bin/python
+"""Regression checks of the analyzer on synthetic inputs.
+
+Every check returns a list of messages describing failures, an empty list
+means that the check passed. The script runs all checks and exits with
+status 1 if any of them fails."""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+from analyzer import Analyzer, AnalyzerError, load_colors
+import benchmark
+import labeling
+import synthetic
+
+# the largest allowed exponent of time = c * pixels ** exponent
+MAX_EXPONENT = 1.3
+# lengths of thinned synthetic roots measured by the first version of the
+# analyzer, see check_baseline_lengths()
+BASELINE_LENGTHS = "regression-lengths.json"
+
+def comb(teeth, height = 51):
+    """Return mask of a comb with 'teeth' one pixel wide vertical teeth
+    separated by one pixel and joined by a bar in the bottom row."""
+    mask = numpy.zeros((height, 2 * teeth), dtype=numpy.uint8)
+    mask[:, ::2] = 1
+    mask[-1] = 1
+    return mask
+
+def serpentine(turns, length = 200):
+    """Return mask of a one pixel wide path that goes 'turns' times from
+    left to right and back, rows of the path are separated by one pixel."""
+    mask = numpy.zeros((2 * turns - 1, length), dtype=numpy.uint8)
+    mask[::2] = 1
+    # joins alternate between the right and the left end of the rows
+    mask[1::4, -1] = 1
+    mask[3::4, 0] = 1
+    return mask
+
+def check_labeling(sizes = (500, 1000, 2000, 4000), repeat = 3):
+    """Check that labeling and pruning of combs and serpentines scale
+    linearly with the number of pixels. Groups that touch many other
+    groups must be merged in a few passes."""
+    failures = []
+    # (name, function that creates the mask, number of groups of the mask),
+    # gaps between teeth and rows of the path are separate groups
+    shapes = (("comb", comb, lambda size: size + 1),
+            ("serpentine", serpentine, lambda size: size))
+    for name, make, groups in shapes:
+        for function in ("label", "prune"):
+            times = {}
+            for size in sizes:
+                mask = make(size)
+                if function == "label":
+                    count = labeling.label(mask)[1]
+                    if count != groups(size):
+                        failures.append("%s %d has %d groups instead of %d."
+                                % (name, size, count, groups(size)))
+                    run = lambda: labeling.label(mask)
+                else:
+                    run = lambda: labeling.prune(mask.copy(), 0)
+                key = "%dx%d" % (mask.shape[1], mask.shape[0])
+                times[key] = benchmark.best_time(run, repeat)
+            scaling = benchmark.exponent(times)
+            if scaling > MAX_EXPONENT:
+                failures.append("%s of %s scales with exponent %.2f." % (function, name, scaling))
+    return failures
+
+def check_thinned_roots(roots = 6, size = (300, 400), depth = 3,
+        thicknesses = (3, 5, 7, 9)):
+    """Check that synthetic roots thinned by the analyzer can be measured.
+    Crossings of thinned skeletons are not as simple as crossings of the
+    generated skeletons, junction pixels of a crossing may touch other
+    pixels of its branches. Ragged edges of thick roots leave spurs that
+    have to be pruned, so roots of each of given 'thicknesses' are tried."""
+    failures = []
+    colors = load_colors()
+    for thickness in thicknesses:
+        for seed in xrange(roots):
+            img, skel = synthetic.generate(size, depth, seed=seed,
+                    thickness=thickness)
+            analyzer = Analyzer(img, colors)
+            try:
+                analyzer.analyze(img, benchmark.DPI, benchmark.GROUP_THRESHOLD)
+            except AnalyzerError as e:
+                failures.append("root %d (%d pixels thick): %s"
+                        % (seed, thickness, e))
+    return failures
+
+def check_baseline_lengths(path = BASELINE_LENGTHS):
+    """Check that synthetic roots thinned by the analyzer have the same
+    sections as measured by the first version of the analyzer.
+
+    The file holds the parameters of the roots and a list of sections
+    (color, length) of each root, roots are generated with seeds 0, 1, ...
+    Roots that the first version could not measure are null, these must
+    be measured now."""
+    failures = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, path)) as f:
+        baseline = json.load(f)
+    colors = load_colors()
+    for seed, expected in enumerate(baseline["roots"]):
+        img, skel = synthetic.generate(baseline["size"], baseline["depth"], seed=seed)
+        analyzer = Analyzer(img, colors)
+        try:
+            pixels, data = analyzer.analyze(img, baseline["dpi"],
+                    baseline["group_threshold"])
+        except AnalyzerError as e:
+            failures.append("root %d: %s" % (seed, e))
+            continue
+        if expected is None:
+            continue
+        measured = [(d["barva"], d["delka"]) for d in data]
+        if (len(measured) != len(expected)
+                or any(color != c or abs(length - l) > 1e-4
+                    for (color, length), (c, l) in zip(measured, expected))):
+            failures.append("root %d: sections %s instead of %s."
+                    % (seed, measured, expected))
+    return failures
+
+def check_directory_scripts(roots = 2, size = (200, 260)):
+    """Check that analyze-root.py and analyze-skeleton.py measure a
+    directory of synthetic roots into a target directory that does not
+    exist yet. The results file lies in the target directory, as in the
+    layout of analyze.sh."""
+    failures = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp()
+    try:
+        images = os.path.join(directory, "colored-roots")
+        skeletons = os.path.join(directory, "skeletons")
+        os.mkdir(images)
+        os.mkdir(skeletons)
+        names = ["root%d" % (seed) for seed in xrange(roots)]
+        for seed, name in enumerate(names):
+            img, skel = synthetic.generate(size, seed=seed)
+            img.save(os.path.join(images, name + ".png"))
+            skel.save(os.path.join(skeletons, name + ".skel.png"))
+        runs = (("analyze-root.py", [images]),
+                ("analyze-skeleton.py", [images, skeletons]))
+        for script, sources in runs:
+            target = os.path.join(directory, os.path.splitext(script)[0],
+                    "colored-skeletons")
+            stats = os.path.join(target, "results.csv")
+            # scripts read colors.cfg from the working directory
+            process = subprocess.Popen([sys.executable, os.path.join(here, script)]
+                    + sources + [target, stats], cwd=here,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            if process.returncode != 0:
+                failures.append("%s failed: %s" % (script, output.strip().splitlines()[-1]))
+                continue
+            with open(stats) as f:
+                measured = set(line.split(";", 1)[0] for line in f.readlines()[1:])
+            if measured != set(names):
+                failures.append("%s measured images %s instead of %s."
+                        % (script, sorted(measured), names))
+    finally:
+        shutil.rmtree(directory)
+    return failures
+
+CHECKS = (check_labeling, check_thinned_roots, check_baseline_lengths,
+        check_directory_scripts)
+
+if __name__=="__main__":
+    failed = 0
+    for check in CHECKS:
+        start = time.time()
+        failures = check()
+        print "%s: %s (%.1f s)" % (check.__name__, "failed" if failures else "ok",
+                time.time() - start)
+        for failure in failures:
+            print "Error: %s" % (failure)
+        failed += bool(failures)
+    if failed:
+        exit(1)
@@ -0,0 +1,238 @@
+"""Measuring of directories of images and saving of skeleton measurements."""
+import os
+import cache
+import instrument
+import parallel
+
+# extensions of images of roots, other files are ignored
+IMAGE_EXTENSIONS = (".bmp", ".png", ".jpg", ".jpeg")
+# extensions of images written by the scripts
+OUTPUT_EXTENSIONS = (".root.png", ".skel.png", ".cols.png")
+
+def list_images(directory):
+    """Return sorted list of (name, path) of images of roots in 'directory',
+    name is the filename without extension. Images written by the scripts
+    are skipped."""
+    images = []
+    for filename in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(filename)
+        path = os.path.join(directory, filename)
+        if (os.path.isfile(path) and ext.lower() in IMAGE_EXTENSIONS
+                and not filename.endswith(OUTPUT_EXTENSIONS)):
+            images.append((name, path))
+    return images
+
+def measure_images(function, images, target, parameters, jobs = 1,
+        timings = None, writer = None, force = False):
+    """Measure 'images' by 'function' in 'jobs' processes.
+
+    'images' is a list of (name, sources, target path, task) tuples, one
+    for each image. 'sources' are the files the results depend on, the last
+    of them names the image in messages and in the timings. 'function' is
+    called with 'task' as arguments and returns tuple (data, errors, record)
+    of the image.
+
+    The manifest of directory 'target' (see cache.py) keeps results of
+    images and their keys computed from 'sources' and 'parameters'. Images
+    whose results are up to date are not measured again unless 'force' is
+    True. If 'timings' is given, stages and counters of each measured image
+    are written into that file as JSON Lines.
+
+    If 'writer' is given (see MeasurementsWriter), results of each image
+    are written by it as soon as the image is measured and images that are
+    already complete in it are skipped. Otherwise results of all images are
+    returned.
+
+    Returns tuple (results, errors) where results are results of all images
+    and errors is number of errors."""
+    manifest = cache.Manifest(target)
+    done = set(writer.done()) if writer else set()
+    tasks = []
+    measured = [] # (name, sources, target path, key, True if measured again)
+    for name, sources, target_path, task in images:
+        if name in done:
+            print "%s is already in the results" % (sources[-1])
+            continue
+        key = manifest.key(sources, *parameters)
+        measure = force or not manifest.is_current(target_path, key)
+        if measure:
+            tasks.append(task)
+        else:
+            print "%s is up to date" % (sources[-1])
+        measured.append((name, sources, target_path, key, measure))
+
+    measurements = [] # results of each image if there is no writer
+    errors = 0
+    # records of images that are not measured again are kept
+    log = instrument.open_records(timings, set(image[1][-1]
+            for image in measured if image[4])) if timings else None
+    results = parallel.imap(function, tasks, jobs)
+    try:
+        for position, (name, sources, target_path, key, measure) in enumerate(measured):
+            if measure:
+                data, error, record = results.next()
+                for d in data:
+                    d["jmeno"] = name
+                if not error:
+                    manifest.update(target_path, key, data)
+                errors += error
+                if log:
+                    instrument.write_record(log, record)
+            else:
+                data = manifest.data(target_path)
+            if writer:
+                writer.write(position, data, name)
+            else:
+                measurements.append(data)
+    finally:
+        if log:
+            log.close()
+        # images measured before an error or an interrupt are not measured
+        # again
+        manifest.save()
+    # files will be ordered alphabetically in the csv, which writes the
+    # results in reverse order
+    return [d for data in reversed(measurements) for d in data], errors
+
+def save_skeleton_measurements(data, target, colors, store = None):
+    """Saves result of the measurement into the target file.
+
+    Format of the file is csv. Each element in the data will be saved
+    into one line. Elements of the data will be separated by colons.
+    The first line contains header. Colors are used to name the columns
+    with counts of neighbouring colors. Elements are written in reverse
+    order.
+
+    If 'store' is given (see store.ResultsStore), elements are also saved
+    into it for each image named by their "jmeno"."""
+    with MeasurementsWriter(target, colors) as writer:
+        writer.write(0, data)
+    if store:
+        names = [] # in order of first element of each image
+        images = {}
+        for d in data:
+            if d["jmeno"] not in images:
+                names.append(d["jmeno"])
+                images[d["jmeno"]] = []
+            images[d["jmeno"]].append(d)
+        for name in names:
+            store.save(name, images[name])
+
+class MeasurementsWriter:
+    """Csv file with measurements that are written as images are measured.
+
+    Measurements of each image are passed to write() together with the
+    position of the image. Images that come before their turn wait in a
+    buffer, so the rows are always in the order of positions even when the
+    images are measured out of order. Rows are flushed to the file after
+    each image, so a crash loses only the images in the buffer.
+
+    With 'resume' an existing file is continued. Rows of images that are
+    already complete in the file are kept and done() returns their names,
+    rows of the last image in the file are removed because they may be
+    incomplete. Format of the file is the same as written by
+    save_skeleton_measurements().
+
+    If 'store' is given (see store.ResultsStore), measurements of each
+    image that has a name are also saved into it."""
+
+    def __init__(self, target, colors, resume = False, store = None):
+        # this specifies which columns will be written out and in which order
+        leading_headers = [
+                "jmeno",
+                "barva",
+                "delka"
+                ]
+        other_headers = [
+                "%s" % (c[0]) for c in colors
+                ]
+        other_headers.append("bila")
+        self._headers = leading_headers + other_headers
+        self._done = [] # names of images complete in the resumed file
+        self._next = 0 # position of the image that is written next
+        self._waiting = {} # position -> data of images measured too early
+        self._store = store
+        if resume and os.path.exists(target) and self._resume(target):
+            self._file = open(target, "a")
+        else:
+            self._file = open(target, "w")
+            self._file.write(";".join(self._headers) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def done(self):
+        """Return list of names of images complete in the resumed file."""
+        return list(self._done)
+
+    def write(self, position, data, name = None):
+        """Write measurements 'data' of image on 'position' as soon as all
+        images before it are written. Positions are numbered from 0, rows
+        of one image are written in reverse order. Measurements are saved
+        into the store immediately under the 'name' of the image."""
+        if self._store and name is not None:
+            self._store.save(name, data)
+        self._waiting[position] = data
+        while self._next in self._waiting:
+            for row in reversed(self._waiting.pop(self._next)):
+                self._file.write(self._format(row))
+            self._next += 1
+        self._file.flush()
+
+    def close(self):
+        """Write images that still wait for images before them and close
+        the file."""
+        for position in sorted(self._waiting):
+            for row in reversed(self._waiting[position]):
+                self._file.write(self._format(row))
+        self._waiting = {}
+        self._file.close()
+
+    def _resume(self, target):
+        """Find complete images in file 'target' and cut off the rest.
+
+        Returns False if the file has different columns and must be
+        written again."""
+        with open(target, "rb") as f:
+            content = f.read()
+        lines = content.split("\n")
+        if len(lines) < 2 or lines[0].rstrip("\r") != ";".join(self._headers):
+            print "Warning: Results '%s' have different columns, they will be written again." % (target)
+            return False
+        # the last line is incomplete or empty
+        offset = len(lines[0]) + 1
+        names = [] # name of each complete line
+        ends = [] # offset after each complete line
+        for line in lines[1:-1]:
+            offset += len(line) + 1
+            names.append(line.split(";", 1)[0])
+            ends.append(offset)
+        # rows of the last image may be incomplete
+        keep = len(names)
+        while keep > 0 and names[keep - 1] == names[-1]:
+            keep -= 1
+        with open(target, "r+b") as f:
+            f.truncate(ends[keep - 1] if keep else len(lines[0]) + 1)
+        for name in names[:keep]:
+            if not self._done or self._done[-1] != name:
+                self._done.append(name)
+        return True
+
+    def _format(self, row):
+        records = []
+        for column in self._headers:
+            record = row[column] if row.has_key(column) else 0
+            if type(record) == int:
+                record = "%d" % (record)
+            elif type(record) == float:
+                record = "%0.4f" % (record)
+            elif type(record) == str:
+                pass
+            else:
+                print "Error: Unexpected type '%s' of value '%s'. Allowed are int, float and str." % (type(record), record)
+                record = str(record)
+            records.append(record)
+        return ";".join(records) + "\n"
@@ -0,0 +1,104 @@
+"""Database of skeleton measurements of many experiments.
+
+Measured sections of roots are kept in one SQLite database, so questions
+over many experiments do not need to read csv files of all runs. Every
+section is identified by the experiment (prefix of the directories of the
+run, see analyze.sh), the name of the image, its position in the results
+of the image and a hash of the parameters it was measured with. When an
+image is measured again with the same parameters, its sections are
+replaced. Sections measured with other parameters are kept, but only the
+latest measurement of each image is current and summaries use only current
+sections unless parameters are given."""
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sections (
+    experiment TEXT NOT NULL,
+    name TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    section INTEGER NOT NULL,
+    color TEXT NOT NULL,
+    length REAL NOT NULL,
+    neighbours TEXT NOT NULL,
+    current INTEGER NOT NULL,
+    PRIMARY KEY (experiment, name, parameters, section)
+);
+CREATE INDEX IF NOT EXISTS sections_name ON sections (name);
+CREATE INDEX IF NOT EXISTS sections_color ON sections (color, current, length);
+"""
+
+# columns of rows of results that are not counts of neighbouring colors
+_COLUMNS = ("jmeno", "barva", "delka")
+
+class ResultsStore:
+    """Sections of roots measured in one experiment with given parameters.
+
+    'parameters' is a hash of the parameters of the measurement, see
+    cache.parameters_digest(). Sections of one image are saved in one
+    transaction."""
+
+    def __init__(self, path, experiment, parameters):
+        self._experiment = experiment
+        self._parameters = parameters
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def save(self, name, data):
+        """Replace sections of image 'name' by rows 'data' of its results.
+
+        Sections of the image measured with other parameters are no longer
+        current."""
+        rows = []
+        for section, row in enumerate(data):
+            neighbours = dict((k, v) for k, v in row.iteritems() if k not in _COLUMNS)
+            rows.append((self._experiment, name, self._parameters, section,
+                    row["barva"], row["delka"],
+                    json.dumps(neighbours, sort_keys=True)))
+        with self._connection:
+            self._connection.execute("""DELETE FROM sections
+                    WHERE experiment = ? AND name = ? AND parameters = ?""",
+                    (self._experiment, name, self._parameters))
+            self._connection.execute("""UPDATE sections SET current = 0
+                    WHERE experiment = ? AND name = ? AND current = 1""",
+                    (self._experiment, name))
+            self._connection.executemany("""INSERT INTO sections
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 1)""", rows)
+
+    def close(self):
+        self._connection.close()
+
+def summary(path, experiment = None, name = None, parameters = None, images = False):
+    """Return lengths of sections in database 'path' summed by color.
+
+    Sections can be limited to an experiment, an image and parameters, by
+    default only current sections are used. If 'images' is True, lengths
+    are summed for each image separately. Returns list of tuples (name,
+    color, sections, total, mean, minimum, maximum), name is None if
+    'images' is False. Lengths are in milimeters."""
+    conditions = []
+    arguments = []
+    for column, value in (("experiment", experiment), ("name", name),
+            ("parameters", parameters)):
+        if value is not None:
+            conditions.append("%s = ?" % column)
+            arguments.append(value)
+    if parameters is None:
+        conditions.append("current = 1")
+    groups = "name, color" if images else "color"
+    query = """SELECT %s, color, COUNT(*), SUM(length), AVG(length),
+            MIN(length), MAX(length) FROM sections %s GROUP BY %s ORDER BY %s""" % (
+            "name" if images else "NULL",
+            "WHERE " + " AND ".join(conditions) if conditions else "",
+            groups, groups)
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(query, arguments).fetchall()
+    finally:
+        connection.close()
@@ -0,0 +1,171 @@
+"""Synthetic images of colored roots.
+
+A root is a tree of straight branches. The main root grows down from the
+top of the image and every branch has side branches of the next level at
+random places along it until the given depth is reached. Branches are
+split into sections colored by consecutive colors of a sequence, so the
+image can be measured like a scanned root. The skeleton is the one pixel
+thick line along the middle of the branches, crossroads are kept simple so
+that the skeleton can always be measured. Painted branches do not touch
+each other, so the image thinned by the analyzer has no loops either. Noise
+specks can be scattered over the background to give filtering of small
+groups some work."""
+import math
+import random
+import numpy
+from PIL import Image, ImageDraw
+
+# blue, red, green and orange of colors.cfg
+SEQUENCE = ((0x4b, 0x60, 0xf9), (0xe3, 0x04, 0x20), (0x1e, 0x98, 0x1d),
+        (0xef, 0x8a, 0x00))
+
+def generate(size, depth = 3, sequence = SEQUENCE, specks = 0, thickness = 5,
+        seed = None):
+    """Generate image of a root of given (width, height) 'size'.
+
+    'depth' is the number of levels of side branches and 'sequence' is a
+    list of at least two (r, g, b) colors of sections of the branches. The
+    main root goes through all colors of the sequence, side branches start
+    with the color that follows the color they grow from. 'specks' is the
+    number of noise specks on the background and 'thickness' is the width
+    of branches in pixels. The same 'seed' always gives the same image.
+
+    Returns tuple (img, skeleton) of RGB image of the root on white
+    background and black and white image of its skeleton."""
+    if len(sequence) < 2:
+        raise ValueError("Branches need at least two colors.")
+    width, height = size
+    rand = random.Random(seed)
+    lines = numpy.zeros((height, width), dtype=numpy.uint8)
+    painted = [] # (pixels, first color, section ends) of each branch
+    # (pixels, angle, level, first color) of grown branches, angle 0 points
+    # down
+    angle = rand.uniform(-0.2, 0.2)
+    branches = [(_grow(lines, width // 2, thickness, angle,
+            height - 3 * thickness, thickness), angle, 0, 0)]
+    while branches:
+        pixels, angle, level, first = branches.pop()
+        if not pixels:
+            continue
+        # deeper branches have less sections, side branches have at most
+        # len(sequence) - 1 sections so none of them has the color of the
+        # section they grow from
+        sections = max(1, min(len(sequence) - level, len(pixels) - 1))
+        ends = [(len(pixels) - 1) * i // sections for i in xrange(1, sections + 1)]
+        painted.append((pixels, first, ends))
+        if level >= depth:
+            continue
+        # side branches grow to both sides at least four widths apart and
+        # not too close to the end of a section, a few following pixels
+        # are tried if a branch cannot grow from a pixel
+        parent = set(pixels)
+        side = rand.choice((-1, 1))
+        k = rand.randint(3 * thickness, 6 * thickness)
+        while k < len(pixels) - 3 * thickness:
+            for k in xrange(k, k + thickness):
+                if any(abs(k - end) <= thickness for end in ends):
+                    continue
+                x, y = pixels[k]
+                a = angle + side * rand.uniform(0.8, 1.5)
+                branch = _grow(lines, x, y, a,
+                        len(pixels) * rand.uniform(0.3, 0.6), thickness, parent)
+                if branch:
+                    section = sum(1 for end in ends if end <= k)
+                    branches.append((branch, a, level + 1, first + section + 1))
+                    side = -side
+                    break
+            k += rand.randint(4 * thickness, 8 * thickness)
+
+    img = Image.new("RGB", size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    # side branches are painted first, so crossings have the color of the
+    # branch they grow from
+    for pixels, first, ends in reversed(painted):
+        begin = 0
+        for i, end in enumerate(ends):
+            # sections overlap by one pixel, so there are no gaps
+            color = sequence[(first + i) % len(sequence)]
+            draw.line(pixels[begin:end + 1], width=thickness, fill=color)
+            # wide lines do not always cover their middle
+            draw.point(pixels[begin:end + 1], fill=color)
+            begin = end
+    _speckle(draw, lines, specks, sequence, thickness, rand)
+    return img, Image.fromarray(lines * numpy.uint8(255))
+
+def _line(x0, y0, x1, y1):
+    """Return list of (x, y) pixels of eight connected line between two
+    points, both points are included. Line has exactly one pixel in each
+    row or in each column, so it has no redundant corners."""
+    x1, y1 = int(round(x1)), int(round(y1))
+    steps = max(abs(x1 - x0), abs(y1 - y0))
+    xs = numpy.rint(numpy.linspace(x0, x1, steps + 1)).astype(int)
+    ys = numpy.rint(numpy.linspace(y0, y1, steps + 1)).astype(int)
+    return zip(xs.tolist(), ys.tolist())
+
+def _grow(lines, x, y, angle, length, thickness, parent = ()):
+    """Grow branch from pixel (x, y) in direction 'angle' and mark it in
+    'lines'.
+
+    The branch stops at the border of the image or before it comes closer
+    than 'thickness' to another branch. If (x, y) belongs to another
+    branch, the branch grows from its neighbour, 'parent' is the set of
+    (x, y) pixels of that branch. Returns list of (x, y) pixels of the
+    branch or an empty list if it cannot grow."""
+    h, w = lines.shape
+    dx, dy = math.sin(angle), math.cos(angle)
+    near = 0
+    top = thickness
+    if lines[y, x]:
+        # branch grows from its parent, its first pixel may touch only the
+        # pixel it grows from, crossroads of three mutually touching pixels
+        # are ambiguous
+        free = [(sx, sy) for sx in (-1, 0, 1) for sy in (-1, 0, 1)
+                if lines[y + sy - 1:y + sy + 2, x + sx - 1:x + sx + 2].sum() == 1]
+        if not free:
+            return []
+        sx, sy = max(free, key=lambda s: (s[0] * dx + s[1] * dy) / math.hypot(*s))
+        x, y = x + sx, y + sy
+        # pixels near the parent are only checked for neighbours
+        near = 2 * thickness + 2
+        # the main root starts at the highest tail
+        top = 2 * thickness
+    pixels = []
+    for j, (px, py) in enumerate(_line(x, y, x + length * dx, y + length * dy)):
+        if not (thickness <= px < w - thickness and top <= py < h - thickness):
+            break
+        if j >= near:
+            if lines[py - thickness:py + thickness + 1,
+                    px - thickness:px + thickness + 1].any():
+                break
+        else:
+            if lines[py - 1:py + 2, px - 1:px + 2].sum() > (j == 0 and near):
+                break
+            # only the parent may be close, painted branches that touch
+            # would form a loop
+            ys, xs = numpy.nonzero(lines[py - thickness:py + thickness + 1,
+                    px - thickness:px + thickness + 1])
+            if any((px - thickness + sx, py - thickness + sy) not in parent
+                    for sx, sy in zip(xs.tolist(), ys.tolist())):
+                break
+        pixels.append((px, py))
+    if len(pixels) < max(2, near):
+        # short side branches would be covered by their parent
+        return []
+    for px, py in pixels:
+        lines[py, px] = 1
+    return pixels
+
+def _speckle(draw, lines, specks, sequence, thickness, rand):
+    """Draw 'specks' small dots of colors of 'sequence' on the background
+    away from the branches in 'lines'."""
+    h, w = lines.shape
+    margin = 2 * thickness
+    if w <= 2 * margin or h <= 2 * margin:
+        return
+    for i in xrange(specks):
+        x = rand.randrange(margin, w - margin)
+        y = rand.randrange(margin, h - margin)
+        if lines[y - margin:y + margin + 1, x - margin:x + margin + 1].any():
+            continue
+        r = rand.randint(0, 1)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=rand.choice(sequence))
@@ -0,0 +1,158 @@
+"""Thinning of black and white images of roots into skeletons.
+
+Foreground pixels are removed in two alternating parallel subiterations
+until only a one pixel thick, eight connected skeleton remains. Which
+pixels can be removed is decided by a lookup table indexed by the
+configuration of the eight neighbours of the pixel (Guo and Hall, 1989,
+a refinement of the Zhang-Suen algorithm that does not leave two pixel
+thick diagonal lines).
+
+Ragged ends and bumps of thick roots leave short side branches, spurs, in
+the skeleton. Spurs are removed when they are short compared to the radius
+of the root at their crossing, which is the number of the last iteration
+that removed pixels around the crossing."""
+import itertools
+import numpy
+import topology
+
+# spurs up to this many radii of the root at their crossing are removed
+SPUR_RADII = 1.5
+
+# weight of each neighbour in the neighbourhood code of a pixel, bit 0 is
+# the right neighbour, following bits go counterclockwise
+_WEIGHTS = (
+        (( 0,  1), 1),   # right
+        ((-1,  1), 2),   # top right
+        ((-1,  0), 4),   # top
+        ((-1, -1), 8),   # top left
+        (( 0, -1), 16),  # left
+        (( 1, -1), 32),  # bottom left
+        (( 1,  0), 64),  # bottom
+        (( 1,  1), 128)  # bottom right
+        )
+
+def _generate_tables():
+    """Generate lookup tables of removable pixels for both subiterations."""
+    first = numpy.zeros(256, dtype=bool)
+    second = numpy.zeros(256, dtype=bool)
+    for code in xrange(256):
+        bits = [bool(code >> i & 1) for i in xrange(8)]
+        # number of eight connected groups of foreground neighbours
+        groups = sum(1 for i in (0, 2, 4, 6)
+                if not bits[i] and (bits[i + 1] or bits[(i + 2) % 8]))
+        # counts of neighbouring pixel pairs that contain foreground
+        n1 = sum(1 for k in (1, 3, 5, 7) if bits[k] or bits[k - 1])
+        n2 = sum(1 for k in (1, 3, 5, 7) if bits[k] or bits[(k + 1) % 8])
+        removable = groups == 1 and 2 <= min(n1, n2) <= 3
+        # first subiteration removes pixels on bottom right edges, second
+        # subiteration pixels on top left edges
+        first[code] = removable and not (
+                (bits[1] or bits[2] or not bits[7]) and bits[0])
+        second[code] = removable and not (
+                (bits[5] or bits[6] or not bits[3]) and bits[4])
+    return first, second
+
+_TABLES = _generate_tables()
+
+def skeletonize(mask, prune = True):
+    """Compute skeleton of foreground pixels in 'mask'.
+
+    'mask' is a two dimensional array where non zero pixels are foreground.
+    If 'prune' is True, spurs are removed from the skeleton. Returns uint8
+    array of the same shape where skeleton pixels are 1 and other pixels
+    are 0."""
+    mask = numpy.asarray(mask)
+    skeleton = numpy.zeros(mask.shape, dtype=numpy.uint8)
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    if not rows.size:
+        return skeleton
+    # work only on the bounding box of the foreground with one pixel border
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    pixels = numpy.zeros((bottom - top + 2, right - left + 2), dtype=numpy.uint8)
+    pixels[1:-1, 1:-1] = mask[top:bottom, left:right] != 0
+    # iteration that removed each pixel
+    removed = numpy.zeros(pixels.shape, dtype=numpy.uint16)
+    _thin(pixels, removed)
+    if prune and _prune(pixels, removed):
+        # pixels of crossings left by removed spurs may be redundant
+        _thin(pixels, removed)
+    skeleton[top:bottom, left:right] = pixels[1:-1, 1:-1]
+    return skeleton
+
+def _thin(pixels, removed):
+    """Remove pixels from 'pixels' until only the skeleton remains. Number
+    of the iteration that removed a pixel is stored in 'removed'."""
+    iteration = 0
+    changed = True
+    while changed:
+        changed = False
+        iteration += 1
+        for table in _TABLES:
+            remove = table[_codes(pixels)]
+            remove &= pixels[1:-1, 1:-1] != 0
+            if remove.any():
+                pixels[1:-1, 1:-1][remove] = 0
+                removed[1:-1, 1:-1][remove] = iteration
+                changed = True
+
+def _prune(pixels, removed):
+    """Remove spurs from skeleton 'pixels' with a border of background
+    pixels, 'removed' holds iterations that removed other pixels. Returns
+    True if any spur was removed.
+
+    A spur is traced from an end of the skeleton to the first junction
+    pixel. If more spurs leave the same crossing, the longest of them is
+    kept, it is the end of a branch that forks at its rounded end."""
+    width = pixels.shape[1]
+    indexes = numpy.flatnonzero(pixels)
+    codes = topology.neighbourhood_points(indexes, width)
+    kinds = topology.kinds(codes)
+    labels, count = topology.junctions_points(indexes, kinds, width)
+    junctions = indexes[kinds == topology.JUNCTION].tolist()
+    crossing = dict(itertools.izip(junctions, labels.tolist()))
+    codes = dict(itertools.izip(indexes.tolist(), codes.tolist()))
+    offsets = topology.offsets(width)
+    direct = set((-width, -1, 1, width))
+    flat = removed.ravel()
+    limit = SPUR_RADII * int(removed.max()) + 1
+    spurs = {} # crossing -> [(length, pixels)] of its spurs
+    for end in indexes[kinds == topology.END].tolist():
+        path = [end]
+        seen = set(path)
+        while len(path) <= limit:
+            index = path[-1]
+            following = [index + o for o in offsets[codes[index]]
+                    if index + o not in seen]
+            entered = [n for n in following if n in crossing]
+            if entered:
+                radius = max(flat[entered[0] + o] for o in offsets[255])
+                if len(path) <= SPUR_RADII * radius:
+                    spurs.setdefault(crossing[entered[0]], []).append(
+                            (len(path), seen))
+                break
+            if not following:
+                break
+            # direct neighbour first, so that no pixel of the spur is skipped
+            following.sort(key=lambda n: n - index not in direct)
+            seen.update(following)
+            path.append(following[0])
+    found = False
+    for leaving in spurs.itervalues():
+        leaving.sort(key=lambda spur: spur[0])
+        if len(leaving) > 1:
+            leaving.pop()
+        for length, seen in leaving:
+            pixels.flat[list(seen)] = 0
+            found = True
+    return found
+
+def _codes(pixels):
+    """Return neighbourhood code of each inner pixel of 'pixels'."""
+    h, w = pixels.shape
+    codes = numpy.zeros((h - 2, w - 2), dtype=numpy.uint8)
+    for (dy, dx), weight in _WEIGHTS:
+        neighbours = pixels[1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx]
+        codes += neighbours * numpy.uint8(weight)
+    return codes
@@ -0,0 +1,82 @@
+"""Topology of one pixel thick skeletons.
+
+Every pixel of a skeleton is classified by its eight neighbours. The
+neighbourhood code of all pixels is computed at once by looking up shifted
+indexes of the pixels, a lookup table then tells whether the pixel is an
+end of the skeleton, lies on a path or joins more paths together.
+
+Functions work with a sorted array of flat indexes of skeleton pixels
+instead of a whole image. Their work and memory depend on the length of
+the skeleton only."""
+import numpy
+import labeling
+
+BACKGROUND = 0
+END = 1 # tail of the skeleton or isolated pixel
+PATH = 2
+JUNCTION = 3
+
+# (dx, dy) of neighbours in the order of bits of the neighbourhood code,
+# neighbours go clockwise around the pixel starting at the top left one
+_RING = ((-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0))
+
+# order of neighbours in offsets(), top to bottom and left to right, branches
+# of crossroads are traced in this order
+_ORDER = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+
+def _generate_kinds():
+    """Generate table of kinds of pixels for each neighbourhood code.
+
+    Neighbours are split into runs of neighbours that follow each other
+    on the ring around the pixel. Pixel with one run is an end of the
+    skeleton, pixel with two runs lies on a path and pixel with three or
+    more runs is a junction. Pixels inside of a thick area are considered
+    to lie on a path."""
+    kinds = numpy.zeros(256, dtype=numpy.uint8)
+    for code in xrange(256):
+        bits = [code >> i & 1 for i in xrange(8)]
+        runs = sum(1 for i in xrange(8) if bits[i] and not bits[i - 1])
+        if code == 0xff:
+            runs = 2
+        kinds[code] = END if runs <= 1 else PATH if runs == 2 else JUNCTION
+    return kinds
+
+_KINDS = _generate_kinds()
+
+def kinds(codes):
+    """Return kinds of skeleton pixels with neighbourhood 'codes'."""
+    return _KINDS[codes]
+
+def neighbourhood_points(indexes, width):
+    """Return neighbourhood codes of pixels with sorted flat 'indexes' in
+    an image of given 'width'.
+
+    Bit i of the code is set if the i-th neighbour in _RING is a pixel of
+    the skeleton."""
+    indexes = numpy.asarray(indexes, dtype=numpy.int64)
+    x = indexes % width
+    codes = numpy.zeros(indexes.size, dtype=numpy.uint8)
+    for bit, (dx, dy) in enumerate(_RING):
+        found = labeling.find_points(indexes, indexes + dy * width + dx) >= 0
+        found &= (x + dx >= 0) & (x + dx < width)
+        codes |= found.astype(numpy.uint8) << bit
+    return codes
+
+def junctions_points(indexes, kinds, width):
+    """Group neighbouring junction pixels of skeleton pixels with sorted
+    flat 'indexes' together. Returns tuple (labels, count) where labels[i]
+    is the crossing of i-th junction pixel, see labeling.label_points()."""
+    indexes = numpy.asarray(indexes)
+    return labeling.label_points(indexes[kinds == JUNCTION], width, eight=True)
+
+def offsets(width, eight = True):
+    """Return table of offsets of neighbours for each neighbourhood code.
+
+    Offsets are differences of flat indexes of neighbours in an image with
+    given width. Neighbours go top to bottom and left to right. If 'eight'
+    is False, only the four direct neighbours are included."""
+    table = []
+    for code in xrange(256):
+        table.append(tuple(dy * width + dx for dx, dy in _ORDER
+                if code >> _RING.index((dx, dy)) & 1 and (eight or not dx or not dy)))
+    return table